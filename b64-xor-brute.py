@@ -1,23 +1,253 @@
-import base64
+import argparse
+import binascii
+import glob
+import json
+import os
 import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from common.base64_utils import decode_base64
+
+# Relative frequencies of the letters a-z followed by space in English text
+ENGLISH_FREQUENCIES = np.array([
+    0.0651738, 0.0124248, 0.0217339, 0.0349835, 0.1041442, 0.0197881, 0.0158610,
+    0.0492888, 0.0558094, 0.0009033, 0.0050529, 0.0331490, 0.0202124, 0.0564513,
+    0.0596302, 0.0137645, 0.0008606, 0.0497563, 0.0515760, 0.0729357, 0.0225134,
+    0.0082903, 0.0171272, 0.0013692, 0.0145984, 0.0007836, 0.1918182,
+])
+# Expected share of bytes that are neither letters nor space (digits, punctuation, newlines)
+OTHER_FREQUENCY = 0.05
+# Weight of the non-printable share in the score: a single binary byte outweighs a poor letter distribution
+NONPRINTABLE_WEIGHT = 1000.0
+
+# Printable ASCII plus tab, newline and carriage return
+PRINTABLE = np.zeros(256, dtype=bool)
+PRINTABLE[32:127] = True
+PRINTABLE[[9, 10, 13]] = True
+
+# Every key byte needs enough ciphertext bytes to be scored, otherwise long keys overfit short inputs
+MIN_COLUMN_LENGTH = 32
+# A longer key fits every column on its own, so its plaintext scores a little better even when it is
+# only a multiple of the real key; the shortest key within this share of the best score wins
+KEY_SIZE_TOLERANCE = 0.25
+# Bytes used to estimate the key length; more doesn't improve the estimate, it only costs time
+KEY_SIZE_SAMPLE = 1 << 16
+
+# Bytes of plaintext shown per input in batch results
+PREVIEW_LENGTH = 120
+
+KEYS = np.arange(256, dtype=np.uint8)
+# XOR_TABLE[key, value] == key ^ value
+XOR_TABLE = np.bitwise_xor(KEYS[:, None], KEYS[None, :])
+# Number of set bits of every byte value
+POPCOUNT = np.unpackbits(KEYS[:, None], axis=1).sum(axis=1)
 
 # The function encrypts the text by performing
-# XOR of all the bytes and the `key` and returns the resultant.   
+# XOR of all the bytes and the `key` and returns the resultant.
 def single_byte_xor(text: bytes, key: int) -> bytes:
-    return bytes([b ^ key for b in text])
+    return np.bitwise_xor(np.frombuffer(text, dtype=np.uint8), np.uint8(key)).tobytes()
+
+# The function XORs the text with a key repeated over its whole length
+def repeating_key_xor(text: bytes, key: bytes) -> bytes:
+    data = np.frombuffer(text, dtype=np.uint8)
+    repeats = -(-len(data) // len(key))
+    return np.bitwise_xor(data, np.tile(np.frombuffer(key, dtype=np.uint8), repeats)[:len(data)]).tobytes()
+
+# Count the byte values at the positions i, i + columns, i + 2 * columns, ... for every column i
+def byte_histograms(text: bytes, columns: int = 1) -> np.ndarray:
+    data = np.frombuffer(text, dtype=np.uint8).astype(np.intp)
+    column = np.arange(len(data)) % columns
+    return np.bincount(column * 256 + data, minlength=columns * 256).reshape(columns, 256)
+
+# Count how often each byte value occurs in every candidate plaintext, for all 256 keys at once.
+# XOR with a key only permutes byte values, so row `key` is the ciphertext histogram indexed
+# by `value ^ key`; the text itself is never decrypted 256 times.
+def candidate_histograms(text: bytes) -> np.ndarray:
+    return byte_histograms(text)[0][XOR_TABLE]
+
+# Score every key for one or more histograms (shape (..., 256)): the share of printable bytes and
+# the chi-squared distance between the case-folded letter/space distribution and English.
+# Returns arrays of shape (..., 256); lower scores are better.
+def score_histograms(histograms: np.ndarray):
+    counts = histograms[..., XOR_TABLE].astype(np.float64)
+    total = np.maximum(histograms.sum(axis=-1), 1)[..., None]
+
+    printable_ratio = counts[..., PRINTABLE].sum(axis=-1) / total
+    letters = counts[..., 65:91] + counts[..., 97:123]
+    observed = np.concatenate([letters, counts[..., 32:33]], axis=-1)
+    observed = np.concatenate([observed, total[..., None] - observed.sum(axis=-1, keepdims=True)], axis=-1)
+    expected = np.append(ENGLISH_FREQUENCIES * (1 - OTHER_FREQUENCY), OTHER_FREQUENCY) * total[..., None]
+    chi_squared = ((observed - expected) ** 2 / expected).sum(axis=-1)
+
+    score = chi_squared / total + NONPRINTABLE_WEIGHT * (1 - printable_ratio)
+    lowercase_ratio = counts[..., 97:123].sum(axis=-1) / total
+    return score, printable_ratio, chi_squared, lowercase_ratio
+
+# Score every single-byte key for the text
+def score_keys(text: bytes):
+    return tuple(values[0] for values in score_histograms(byte_histograms(text)))
+
+# decipher the XORed text by scoring all keys and returning the top_k (key, score, printable ratio,
+# chi-squared, plaintext) tuples, best first
+def decipher_xor(text: bytes, top_k: int = 5):
+    score, printable_ratio, chi_squared, lowercase_ratio = score_keys(text)
+    # Keys differing only in the case bit score the same, prefer the mostly lowercase one
+    ranking = np.lexsort((-lowercase_ratio, score))[:top_k]
+    return [(int(key), float(score[key]), float(printable_ratio[key]), float(chi_squared[key]),
+             single_byte_xor(text, int(key))) for key in ranking]
 
-# decipher the XORed text by brute-forcing the key using the single_byte_xor function
-def decipher_xor(text: bytes) -> bytes:
-    for key in range(256):
-        result = single_byte_xor(text, key)
-        print("Key (decimal): " + str(key) + " : " + str(result))
+# Estimate the most likely lengths of a repeating key. Bytes encrypted with the same key byte
+# keep the (low) Hamming distance of the plaintext, so the text is compared with itself shifted
+# by each candidate length; the normalized distance (differing bits per bit) is lowest for the
+# key length and its multiples.
+def estimate_key_sizes(text: bytes, max_key_size: int = 40, candidates: int = 3):
+    data = np.frombuffer(text, dtype=np.uint8)[:KEY_SIZE_SAMPLE]
+    sizes = range(1, min(max_key_size, len(text) // MIN_COLUMN_LENGTH, len(data) // 2) + 1)
+    distances = [(POPCOUNT[np.bitwise_xor(data[:-size], data[size:])].mean() / 8, size) for size in sizes]
+    return [size for _, size in sorted(distances)[:candidates]]
+
+# Find the shortest key that repeats to the given key
+def shortest_period(key: bytes) -> bytes:
+    for size in range(1, len(key)):
+        if len(key) % size == 0 and key[:size] * (len(key) // size) == key:
+            return key[:size]
+    return key
+
+# Crack a repeating-key XOR: for the most likely key lengths and their divisors, split the text into
+# one column per key byte and solve all columns at once with the single-byte scoring. Returns the
+# (key, score, plaintext) of the shortest key whose plaintext scores within KEY_SIZE_TOLERANCE of the best.
+def crack_repeating_xor(text: bytes, max_key_size: int = 40, candidates: int = 3):
+    # The distance is also low for multiples of the key length, so their divisors are tried too;
+    # a single-byte key is always tried, it is the fallback for inputs too short to estimate
+    sizes = {divisor for size in estimate_key_sizes(text, max_key_size, candidates)
+             for divisor in range(1, size + 1) if size % divisor == 0} | {1}
+    results = []
+    for size in sorted(sizes):
+        score, _, _, lowercase_ratio = score_histograms(byte_histograms(text, size))
+        key = np.lexsort((-lowercase_ratio, score), axis=-1)[:, 0].astype(np.uint8).tobytes()
+        key = shortest_period(key)
+        plaintext = repeating_key_xor(text, key)
+        # Plaintext score: the score of key 0 on the decrypted text
+        results.append((key, float(score_keys(plaintext)[0][0]), plaintext))
+    best_score = min(plaintext_score for _, plaintext_score, _ in results)
+    return next(result for result in results if result[1] <= best_score * (1 + KEY_SIZE_TOLERANCE))
+
+# Expand the command line inputs (files, directories and glob patterns) into file paths
+def expand_inputs(inputs):
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        elif os.path.isfile(pattern):
+            yield pattern
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                print(f"WARNING: No files match {pattern}", file=sys.stderr)
+            for path in matches:
+                if os.path.isfile(path):
+                    yield path
+
+# Analyse one base64 blob and return a machine-readable result; runs in a worker process.
+# `source` is either a file path or the blob itself (stdin lines).
+def analyse_blob(task):
+    name, source, repeating, max_key_size = task
+    result = {"input": name}
+    try:
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                source = f.read()
+        data = decode_base64(source)
+    except (OSError, binascii.Error, ValueError) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    if repeating:
+        key, score, plaintext = crack_repeating_xor(data, max_key_size)
+        result.update(key=key.hex(), key_length=len(key), score=round(score, 4))
+    else:
+        key, score, printable_ratio, _, plaintext = decipher_xor(data, 1)[0]
+        result.update(key=key, score=round(score, 4), printable=round(printable_ratio, 4))
+    result["preview"] = plaintext[:PREVIEW_LENGTH].decode('latin-1')
+    return result
+
+# Yield the analysis tasks for stdin (one blob per line) or the given inputs
+def iter_tasks(inputs, repeating, max_key_size):
+    if not inputs or inputs == ['-']:
+        for number, line in enumerate(sys.stdin.buffer, start=1):
+            if line.strip():
+                yield f"stdin:{number}", line, repeating, max_key_size
+        return
+    for path in expand_inputs(inputs):
+        yield path, path, repeating, max_key_size
+
+# Analyse many blobs across a process pool, writing one JSON line per input as results arrive
+def run_batch(tasks, output, jobs=None):
+    count = 0
+    with Pool(processes=jobs) as pool:
+        for result in pool.imap(analyse_blob, tasks, chunksize=16):
+            output.write(json.dumps(result) + "\n")
+            count += 1
+    return count
+
+# Print the ranked keys of a single file for a human reader
+def print_single(path, args):
+    with open(path, 'rb') as f:
+        data = decode_base64(f.read())
+
+    if args.repeating:
+        key, score, plaintext = crack_repeating_xor(data, args.max_key_size)
+        print(f"Key (hex): {key.hex()} ({len(key)} bytes) : {key!r} score: {score:.3f}")
+        print(plaintext[:1000])
+        return
+
+    if args.all:
+        for key in range(256):
+            result = single_byte_xor(data, key)
+            print("Key (decimal): " + str(key) + " : " + str(result))
+        return
+
+    for key, score, printable_ratio, chi_squared, result in decipher_xor(data, args.top):
+        print(f"Key (decimal): {key} score: {score:.3f} printable: {printable_ratio:.1%} "
+              f"chi2: {chi_squared:.1f} : {result[:200]}")
 
 # python main init function
+def main():
+    parser = argparse.ArgumentParser(
+        description="Brute-force the XOR key of base64 encoded files. A single file prints the ranked keys; "
+                    "several files, directories, globs or stdin (one blob per line) write one JSON result "
+                    "per input.")
+    parser.add_argument("inputs", nargs="*",
+                        help="files, directories or glob patterns; '-' (or nothing, when stdin is piped) reads stdin")
+    parser.add_argument("-k", "--top", type=int, default=5, help="number of best keys to show (default: %(default)s)")
+    parser.add_argument("--all", action="store_true", help="print the output of all 256 keys, unranked")
+    parser.add_argument("-r", "--repeating", action="store_true", help="crack a repeating (multi-byte) XOR key")
+    parser.add_argument("--max-key-size", type=int, default=40,
+                        help="longest repeating key to try (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes for batch mode (default: all CPUs)")
+    args = parser.parse_args()
+    if not args.inputs and sys.stdin.isatty():
+        parser.error("no inputs given; pass files or '-' to read base64 blobs from stdin")
+
+    if len(args.inputs) == 1 and os.path.isfile(args.inputs[0]) and not args.output:
+        try:
+            print_single(args.inputs[0], args)
+        except (binascii.Error, ValueError) as e:
+            print(f"ERROR: {args.inputs[0]} is not valid base64: {e}")
+            sys.exit(1)
+        return
+
+    tasks = iter_tasks(args.inputs, args.repeating, args.max_key_size)
+    if args.output:
+        with open(args.output, 'w') as output:
+            count = run_batch(tasks, output, args.jobs)
+    else:
+        count = run_batch(tasks, sys.stdout, args.jobs)
+    print(f"Analysed {count} inputs.", file=sys.stderr)
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python b64-xor-brute.py <file>")
-        sys.exit(1)
-    
-    with open(sys.argv[1], 'rb') as f:
-        data = f.read()
-        decipher_xor(base64.b64decode(data))
+    main()
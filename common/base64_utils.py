@@ -0,0 +1,21 @@
+import base64
+
+# Maps the URL-safe base64 alphabet onto the standard one
+URLSAFE_TO_STANDARD = bytes.maketrans(b"-_", b"+/")
+
+
+def pad_base64(data):
+    """Makes sure base64 data is padded
+    :param data: the data used in the API that being encoded (str or bytes)"""
+    missing_padding = len(data) % 4
+    if missing_padding != 0:
+        data += ("=" if isinstance(data, str) else b"=") * (4 - missing_padding)
+    return data
+
+
+def decode_base64(data):
+    """Decode standard or URL-safe base64, with or without padding and line breaks.
+    Raises binascii.Error for anything else.
+    :param data: the base64 encoded bytes"""
+    data = b"".join(data.split()).translate(URLSAFE_TO_STANDARD).rstrip(b"=")
+    return base64.b64decode(pad_base64(data), validate=True)
@@ -0,0 +1,127 @@
+import json
+import logging
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from common import http_client
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Each aliased repository costs a handful of nodes (repository, defaultBranchRef, target);
+# 100 aliases per query keeps us far below GitHub's 500,000 node and complexity limits
+# while still replacing ~100 REST calls with a single request.
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_RETRIES = 3
+
+REPOSITORY_FIELDS = """
+    nameWithOwner
+    isArchived
+    pushedAt
+    defaultBranchRef {
+        name
+        target {
+            ... on Commit {
+                committedDate
+            }
+        }
+    }
+"""
+
+def chunked(items, size):
+    """Split a list into consecutive chunks of at most `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def build_repository_query(repo_list):
+    """Build one aliased GraphQL query for a list of 'owner/name' strings."""
+    queries = []
+    for i, repo in enumerate(repo_list):
+        owner, name = repo.split('/')
+        queries.append(f"""
+            repo{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{
+                {REPOSITORY_FIELDS}
+            }}
+        """)
+    return f"query {{ {' '.join(queries)} }}"
+
+def parse_repository(value):
+    """Flatten a GraphQL repository node into the fields our scripts use."""
+    branch = value.get("defaultBranchRef") or {}
+    target = branch.get("target") or {}
+    return {
+        "archived": value["isArchived"],
+        "pushed_at": value.get("pushedAt"),
+        "default_branch": branch.get("name"),
+        "last_commit_date": target.get("committedDate"),
+    }
+
+def fetch_repository_chunk(repo_list, token):
+    """Run a single aliased query; returns {nameWithOwner: metadata} or None if the request failed."""
+    headers = {"Authorization": f"Bearer {token}"}
+    try:
+        response = http_client.post(GITHUB_GRAPHQL_URL, headers=headers,
+                                    json={"query": build_repository_query(repo_list)}, idempotent=True)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"GraphQL request failed: {e}")
+        return None
+    if response.status_code != 200:
+        logging.error(f"GraphQL query failed: {response.status_code} - {response.text}")
+        return None
+
+    data = response.json()
+    # Unknown or inaccessible repositories come back as null aliases plus an entry in 'errors'
+    for error in data.get("errors", []):
+        logging.warning(f"GraphQL error: {error.get('message')}")
+    # A query that timed out or exceeded the limits has no 'data' at all
+    if data.get("data") is None:
+        return None
+
+    result = {}
+    for value in data["data"].values():
+        if value:
+            result[value["nameWithOwner"]] = parse_repository(value)
+    return result
+
+def retry_repository_chunk(repo_list, token, retries):
+    """Retry a failed chunk on its own with exponential backoff."""
+    for attempt in range(retries):
+        time.sleep(2 ** attempt)
+        logging.info(f"Retrying batch query for {len(repo_list)} repositories (attempt {attempt + 1}/{retries})...")
+        chunk_result = fetch_repository_chunk(repo_list, token)
+        if chunk_result is not None:
+            return chunk_result
+    logging.error(f"Giving up on batch query for {len(repo_list)} repositories after {retries} retries.")
+    return {}
+
+def fetch_repositories_metadata(repo_list, token, chunk_size=DEFAULT_CHUNK_SIZE,
+                                max_workers=DEFAULT_MAX_WORKERS, retries=DEFAULT_RETRIES):
+    """Fetch archived flag, default branch and last commit date for many repositories.
+
+    Chunks are dispatched concurrently over the shared HTTP client; chunks that fail
+    are retried individually afterwards and all results are merged.
+
+    :param repo_list: list of 'owner/name' strings
+    :param token: GitHub API token
+    :param chunk_size: number of repositories per GraphQL request
+    :param max_workers: number of chunks queried concurrently
+    :param retries: retries for each failed chunk"""
+    result = {}
+    chunks = chunked(repo_list, chunk_size)
+    if not chunks:
+        return result
+
+    logging.info(f"Executing {len(chunks)} batch queries for {len(repo_list)} repositories...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunk_results = list(executor.map(lambda chunk: fetch_repository_chunk(chunk, token), chunks))
+
+    failed_chunks = []
+    for chunk, chunk_result in zip(chunks, chunk_results):
+        if chunk_result is None:
+            failed_chunks.append(chunk)
+        else:
+            result.update(chunk_result)
+
+    for chunk in failed_chunks:
+        result.update(retry_repository_chunk(chunk, token, retries))
+    return result
@@ -0,0 +1,96 @@
+import logging
+
+import requests
+
+from common import http_client
+
+GITHUB_API_URL = "https://api.github.com"
+
+# GitHub's maximum page size for the organization property values endpoint
+PROPERTIES_PAGE_SIZE = 100
+
+def fetch_org_property_values(org, headers, page_cache=None):
+    """Fetch the custom property values of all repositories of an organization.
+
+    Uses /orgs/{org}/properties/values, which returns up to 100 repositories per page,
+    instead of one /repos/{owner}/{repo}/properties/values call per repository.
+
+    :param org: the GitHub organization
+    :param headers: GitHub request headers (authorization)
+    :param page_cache: optional dict {url: {"etag", "data", "next"}} from a previous run; pages are
+        requested with If-None-Match and a 304 (not counted against the rate limit) reuses the
+        cached page. The dict is updated in place and only keeps the pages of this run.
+    :return: {repository_name: {property_name: value}}, or None if a page could not be fetched"""
+    result = {}
+    visited = set()
+    url = f"{GITHUB_API_URL}/orgs/{org}/properties/values?per_page={PROPERTIES_PAGE_SIZE}"
+    while url:
+        cached = page_cache.get(url) if page_cache is not None else None
+        request_headers = dict(headers, Accept="application/vnd.github+json")
+        if cached and cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+
+        try:
+            response = http_client.get(url, headers=request_headers)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to fetch property values: {e}")
+            return None
+
+        if response.status_code == 304:
+            page, next_url = cached["data"], cached.get("next")
+        elif response.status_code == 200:
+            page, next_url = response.json(), response.links.get("next", {}).get("url")
+            if page_cache is not None:
+                page_cache[url] = {"etag": response.headers.get("ETag"), "data": page, "next": next_url}
+        else:
+            logging.error(f"Failed to fetch property values: {response.status_code} - {response.text}")
+            return None
+
+        for repo in page:
+            result[repo["repository_name"]] = {prop["property_name"]: prop.get("value")
+                                               for prop in repo.get("properties", [])}
+        visited.add(url)
+        url = next_url
+
+    # Drop pages the organization no longer has, e.g. after repositories were deleted
+    if page_cache is not None:
+        for stale_url in set(page_cache) - visited:
+            del page_cache[stale_url]
+    logging.info(f"Fetched custom property values of {len(result)} repositories in {org}")
+    return result
+
+def fetch_property_map(org, headers, property_name="RepoOwner", page_cache=None):
+    """Build a {repository_name: value} map of one custom property for all repositories of an organization.
+
+    Repositories without a value for the property map to None. Returns None if the values could not be fetched."""
+    values = fetch_org_property_values(org, headers, page_cache)
+    if values is None:
+        return None
+    return {name: properties.get(property_name) for name, properties in values.items()}
+
+# GitHub's maximum number of repositories per organization property values update
+MAX_PROPERTY_UPDATE_REPOSITORIES = 30
+
+def update_org_property_values(org, headers, repository_names, properties):
+    """Set custom property values on up to 30 repositories of an organization with one request.
+
+    :param org: the GitHub organization
+    :param headers: GitHub request headers (authorization)
+    :param repository_names: names of the repositories to update (at most MAX_PROPERTY_UPDATE_REPOSITORIES)
+    :param properties: list of {"property_name": ..., "value": ...}
+    :return: (success, retryable, detail) where retryable tells whether the failure was a connection
+        error, rate limit (429) or server error (5xx) and detail describes the failure"""
+    if len(repository_names) > MAX_PROPERTY_UPDATE_REPOSITORIES:
+        raise ValueError(f"At most {MAX_PROPERTY_UPDATE_REPOSITORIES} repositories can be updated per request")
+
+    url = f"{GITHUB_API_URL}/orgs/{org}/properties/values"
+    request_headers = dict(headers, Accept="application/vnd.github+json")
+    payload = {"repository_names": list(repository_names), "properties": properties}
+    try:
+        response = http_client.patch(url, headers=request_headers, json=payload, idempotent=True)
+    except requests.exceptions.RequestException as e:
+        return False, True, str(e)
+    if response.status_code in (200, 204):
+        return True, False, ""
+    retryable = response.status_code == 429 or response.status_code >= 500
+    return False, retryable, f"{response.status_code} - {response.text}"
@@ -0,0 +1,99 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from common import http_client
+
+GITHUB_API_URL = "https://api.github.com"
+
+REPOSITORIES_PAGE_SIZE = 100
+DEFAULT_MAX_WORKERS = 8
+
+class RepositoryListingError(RuntimeError):
+    """A page of the repository listing couldn't be fetched, so the listing is incomplete."""
+
+def fetch_repository_page(org, page, headers, sort=None):
+    """Fetch one page of the organization's repositories; returns the response or None if the request failed.
+
+    With `sort` ('created', 'updated', 'pushed' or 'full_name') the newest repositories come first."""
+    url = f"{GITHUB_API_URL}/orgs/{org}/repos?type=all&per_page={REPOSITORIES_PAGE_SIZE}&page={page}"
+    if sort:
+        url += f"&sort={sort}&direction=desc"
+    try:
+        response = http_client.get(url, headers=headers)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to retrieve repositories page {page}: {e}")
+        return None
+    if response.status_code != 200:
+        logging.error(f"Failed to retrieve repositories page {page}: {response.status_code} - {response.text}")
+        return None
+    return response
+
+def last_page_number(response):
+    """Read the page number of the rel="last" Link header; 1 if the listing has a single page."""
+    last_url = response.links.get("last", {}).get("url")
+    if not last_url:
+        return 1
+    return int(parse_qs(urlsplit(last_url).query).get("page", ["1"])[0])
+
+def iter_repositories(org, headers, include_archived=False, max_workers=DEFAULT_MAX_WORKERS):
+    """Yield the repositories of an organization, including private and internal ones.
+
+    The first page tells the number of pages (rel="last" in the Link header); the remaining
+    pages are fetched concurrently and their repositories are yielded in listing order as soon
+    as they arrive. Archived repositories are filtered out unless `include_archived` is set.
+    Raises RepositoryListingError at the first page that can't be fetched, after the repositories
+    of the pages before it were yielded.
+
+    :param org: the GitHub organization
+    :param headers: GitHub request headers (authorization)
+    :param include_archived: also yield archived repositories
+    :param max_workers: number of pages fetched concurrently"""
+    def repositories(response):
+        return [repo for repo in response.json() if include_archived or not repo.get("archived")]
+
+    first = fetch_repository_page(org, 1, headers)
+    if first is None:
+        raise RepositoryListingError(f"Failed to list the repositories of {org} (page 1)")
+    last_page = last_page_number(first)
+    logging.info(f"Listing {last_page} pages of repositories for {org}")
+    yield from repositories(first)
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        futures = [executor.submit(fetch_repository_page, org, page, headers) for page in range(2, last_page + 1)]
+        try:
+            for page, future in enumerate(futures, start=2):
+                response = future.result()
+                if response is None:
+                    raise RepositoryListingError(f"Failed to list the repositories of {org} "
+                                                 f"(page {page} of {last_page})")
+                yield from repositories(response)
+        finally:
+            # Consumers that stop early or a failed page shouldn't wait for pages nobody reads
+            for future in futures:
+                future.cancel()
+
+def iter_repositories_created_since(org, headers, since, include_archived=False):
+    """Yield the repositories of an organization created after `since`, newest first.
+
+    Pages are listed with sort=created&direction=desc one after another and the listing stops at
+    the first older repository, so the cost follows the number of new repositories, not the org size.
+
+    Raises RepositoryListingError if a page can't be fetched.
+
+    :param since: ISO 8601 timestamp ('YYYY-MM-DDTHH:MM:SSZ')"""
+    page = 1
+    while True:
+        response = fetch_repository_page(org, page, headers, sort="created")
+        if response is None:
+            raise RepositoryListingError(f"Failed to list the new repositories of {org} (page {page})")
+        for repo in response.json():
+            if repo["created_at"] <= since:
+                return
+            if include_archived or not repo.get("archived"):
+                yield repo
+        if "next" not in response.links:
+            return
+        page += 1
@@ -0,0 +1,186 @@
+"""Shared HTTP client for the GitHub, Snyk and Wiz scripts.
+
+All requests go through one pooled requests.Session, so connections are kept alive
+between calls. Throttled (403 rate limit / 429) and transient (5xx, connection errors,
+timeouts) failures are retried with exponential backoff, honouring Retry-After and
+X-RateLimit-Reset. When a host throttles us, every thread talking to that host waits.
+
+Usage mirrors the requests module:
+    from common import http_client
+    response = http_client.get(url, headers=headers)"""
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 60
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1
+MAX_BACKOFF = 300
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Methods that can be repeated safely; other methods (POST, PATCH) are only retried when the
+# server rejected the request (429, rate limits) unless the caller passes idempotent=True
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# Gateway errors that mean the upstream timed out; returned at once with retry_timeouts=False
+GATEWAY_TIMEOUT_STATUS_CODES = (502, 504)
+
+# Maximum number of requests in flight per host; hosts not listed use DEFAULT_HOST_CONCURRENCY
+DEFAULT_HOST_CONCURRENCY = 8
+HOST_CONCURRENCY = {
+    "api.github.com": 8,
+    "api.snyk.io": 8,
+    "snyk.io": 4,
+}
+
+
+class HttpClient:
+    """A pooled session with retries, rate-limit handling and per-host concurrency caps."""
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT,
+                 host_concurrency=None, default_host_concurrency=DEFAULT_HOST_CONCURRENCY):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.host_concurrency = dict(HOST_CONCURRENCY, **(host_concurrency or {}))
+        self.default_host_concurrency = default_host_concurrency
+
+        self.session = requests.Session()
+        pool_size = max([default_host_concurrency] + list(self.host_concurrency.values()))
+        self.session.mount("https://", HTTPAdapter(pool_connections=len(self.host_concurrency) + 4,
+                                                   pool_maxsize=pool_size))
+
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._paused_until = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                limit = self.host_concurrency.get(host, self.default_host_concurrency)
+                self._semaphores[host] = threading.BoundedSemaphore(limit)
+            return self._semaphores[host]
+
+    def _pause(self, host, seconds):
+        """Make every thread hold off requests to `host` for `seconds`."""
+        with self._lock:
+            self._paused_until[host] = max(self._paused_until.get(host, 0), time.time() + seconds)
+
+    def _wait_if_paused(self, host):
+        while True:
+            with self._lock:
+                remaining = self._paused_until.get(host, 0) - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _backoff(self, attempt):
+        return min(self.backoff_factor * (2 ** attempt), MAX_BACKOFF)
+
+    def retry_wait(self, response, attempt):
+        """Return the number of seconds to wait before retrying `response`, or None if it should not be retried."""
+        if response.ok:
+            return None
+        headers = response.headers
+        rate_limited = response.status_code == 429 or (
+            response.status_code == 403 and (
+                headers.get("X-RateLimit-Remaining") == "0" or "rate limit" in response.text.lower()))
+        # Other client errors (400, 404, 422, ...) fail the same way again, even with a Retry-After
+        if not rate_limited and response.status_code not in RETRY_STATUS_CODES:
+            return None
+
+        retry_after = headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+
+        reset = headers.get("X-RateLimit-Reset")
+        if rate_limited and reset and reset.isdigit():
+            # GitHub sends an epoch timestamp, other APIs send the seconds until the reset
+            reset = int(reset)
+            return max(reset - time.time(), 1) if reset > 1000000000 else max(reset, 1)
+
+        if rate_limited and "secondary rate limit" in response.text.lower():
+            # GitHub asks to wait at least one minute after hitting a secondary rate limit
+            return max(60, self._backoff(attempt))
+
+        return self._backoff(attempt)
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying throttled and transient failures.
+
+        Returns the last response once retries are exhausted, so callers keep checking
+        status codes as before. Connection errors and timeouts are re-raised; pass
+        retry_timeouts=False to get timeouts and 502/504 gateway timeouts immediately
+        (e.g. to retry a smaller request).
+
+        POST and PATCH requests may have taken effect despite a 5xx response or a dropped
+        connection, so they are only retried after throttling or a failed connect; pass
+        idempotent=True for requests that are safe to repeat (queries, setting values)."""
+        retry_timeouts = kwargs.pop("retry_timeouts", True)
+        idempotent = kwargs.pop("idempotent", method.upper() in IDEMPOTENT_METHODS)
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).hostname
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_if_paused(host)
+            try:
+                with self._semaphore(host):
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries or (
+                        not retry_timeouts and isinstance(e, requests.exceptions.Timeout)) or (
+                        # the request may have reached the server unless the connection was never made
+                        not idempotent and not isinstance(e, requests.exceptions.ConnectTimeout)):
+                    raise
+                wait = self._backoff(attempt)
+                logging.warning(f"{method} {url} failed ({e}), retrying in {wait}s "
+                                f"(attempt {attempt + 1}/{self.max_retries})")
+                time.sleep(wait)
+                continue
+
+            if attempt == self.max_retries:
+                return response
+            if not retry_timeouts and response.status_code in GATEWAY_TIMEOUT_STATUS_CODES:
+                return response
+            if not idempotent and response.status_code >= 500:
+                return response
+            wait = self.retry_wait(response, attempt)
+            if wait is None:
+                return response
+            logging.warning(f"{method} {url} returned {response.status_code}, retrying in {int(wait)}s "
+                            f"(attempt {attempt + 1}/{self.max_retries})")
+            self._pause(host, wait)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+# Process-wide client shared by every script and helper module
+default_client = HttpClient()
+
+def request(method, url, **kwargs):
+    return default_client.request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return default_client.get(url, **kwargs)
+
+def post(url, **kwargs):
+    return default_client.post(url, **kwargs)
+
+def patch(url, **kwargs):
+    return default_client.patch(url, **kwargs)
+
+def delete(url, **kwargs):
+    return default_client.delete(url, **kwargs)
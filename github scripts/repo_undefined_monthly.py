@@ -1,99 +1,125 @@
-import requests
 import os
+import sys
+import json
 import pandas as pd
 import datetime
+import argparse
 from dotenv import load_dotenv
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.github_graphql import fetch_repositories_metadata
+from common.github_properties import fetch_property_map
+from common.github_repositories import RepositoryListingError, iter_repositories
+
 load_dotenv()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def fetch_github_data(url, headers):
-    """Reusable function to fetch data from GitHub API."""
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        logging.error(f"Failed to fetch data: {response.status_code} - {response.text}")
-        return None
+# Number of repository pages fetched concurrently; 1 restores the sequential behaviour
+DEFAULT_WORKERS = int(os.getenv("GITHUB_MAX_WORKERS", "8"))
 
-def fetch_repositories(owner, token):
+# State of the previous run (property pages with ETags, last commit dates); only changed data is re-queried
+STATE_FILE = os.getenv("REPORT_STATE_FILE", 'ccq-utils/github scripts/output/repo_owner_state.json')
+
+def fetch_repositories(owner, token, max_workers=DEFAULT_WORKERS):
     """Fetch all repositories for a specified owner, including private and internal ones, filtering out archived ones."""
     headers = {
         "Accept": "application/vnd.github.v3+json",
         "Authorization": f"Bearer {token}"
     }
-    all_repos = []
-    page = 1
-    while True:
-        url = f"https://api.github.com/orgs/{owner}/repos?type=all&per_page=100&page={page}"
-        logging.info(f"Fetching page {page} for {owner}")
-        
-        repos = fetch_github_data(url, headers)
-        
-        if repos is None:
-            logging.error("Error fetching data. Stopping pagination.")
-            break
-        
-        if not repos:
-            logging.info("No more repositories found. Ending pagination.")
-            break
-        
-        # Filter out archived repositories and add unarchived repos to the list
-        all_repos.extend([repo for repo in repos if not repo.get('archived')])
-        logging.info(f"Page {page} fetched with {len(repos)} repositories (unarchived added: {len(all_repos)})")
-        page += 1
-
+    all_repos = list(iter_repositories(owner, headers, max_workers=max_workers))
     logging.info(f"Total unarchived repositories fetched: {len(all_repos)}")
     return all_repos
 
-def fetch_repo_owner_property(owner, repo, token):
-    """Fetch the 'RepoOwner' property for the repository and check if it's 'undefined'."""
-    url = f"https://api.github.com/repos/{owner}/{repo}/properties/values"
-    headers = {
-        "Accept": "application/vnd.github+json",
-        "Authorization": f"Bearer {token}"
-    }
-    properties = fetch_github_data(url, headers)
-    if properties:
-        for prop in properties:
-            if prop.get('property_name') == 'RepoOwner' and prop.get('value', '').lower() == 'undefined':
-                logging.info(f"'RepoOwner' property for {repo} is set to 'undefined'")
-                return True
-    return False
-
-def fetch_last_commit(owner, repo, token):
-    """Fetch the last commit date for a given repository."""
-    url = f"https://api.github.com/repos/{owner}/{repo}/commits?per_page=1"
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "Authorization": f"Bearer {token}"
-    }
-    commits = fetch_github_data(url, headers)
-    if commits:
-        date_str = commits[0]['commit']['committer']['date']
-        return datetime.datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ').strftime('%d %b %Y')
-    return None
+def is_undefined(repo_owner):
+    """Check whether a 'RepoOwner' value is 'undefined'."""
+    return isinstance(repo_owner, str) and repo_owner.lower() == 'undefined'
+
+def fetch_repo_owner_map(owner, token, page_cache=None):
+    """Fetch the 'RepoOwner' property of all repositories with the organization-level endpoint.
+
+    With the pages of the previous run the requests are conditional: GitHub answers 304 Not Modified,
+    which doesn't count against the rate limit, and the cached page is reused."""
+    headers = {"Authorization": f"Bearer {token}"}
+    return fetch_property_map(owner, headers, 'RepoOwner', page_cache)
+
+def load_state(filename):
+    """Load the state of the previous run, or an empty state on the first run."""
+    try:
+        with open(filename) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        logging.info(f"No previous state found in '{filename}', checking all repositories.")
+        state = {}
+    # Saved in UTC with a 'Z' suffix, parsed back as a timezone-aware datetime
+    updated_at = state.get('updated_at')
+    return {'repositories': state.get('repositories', {}), 'property_pages': state.get('property_pages', {}),
+            'updated_at': datetime.datetime.strptime(updated_at, '%Y-%m-%dT%H:%M:%S%z') if updated_at else None}
+
+def save_state(filename, repositories, property_pages):
+    """Write the per-repository state and the property pages for the next run."""
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'w') as file:
+        json.dump({'updated_at': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                   'repositories': repositories, 'property_pages': property_pages}, file, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
+    logging.info(f"State of {len(repositories)} repositories saved to '{filename}'.")
+
+def has_changed(repo, previous):
+    """Check whether the repository was pushed to or updated since the previous run."""
+    return (not previous or previous.get('pushed_at') != repo.get('pushed_at')
+            or previous.get('updated_at') != repo.get('updated_at'))
+
+def format_commit_date(date_str):
+    """Format a GitHub ISO 8601 timestamp for the report."""
+    if not date_str:
+        return None
+    return datetime.datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S%z').strftime('%d %b %Y')
 
 def extract_prefix(repo_name):
     """Extract prefix from repository name before the first hyphen, or return empty if no hyphen."""
     return repo_name.split('-')[0] if '-' in repo_name else ''
 
-def create_excel(data):
-    """Create an Excel file from the list of repositories, including a 'Prefix' column."""
-    df = pd.DataFrame(data, columns=['Repository', 'Prefix', 'Last Commit Date'])
-    
+def create_excel(data, newly_undefined=(), newly_fixed=()):
+    """Create an Excel file from the list of repositories, including a 'Prefix' column,
+    and the changes since the previous run on separate sheets."""
     filename = 'ccq-utils/github scripts/output/undefined_repo_owner_latest.xlsx'
 
     output_dir = os.path.dirname(filename)
     os.makedirs(output_dir, exist_ok=True)
-    
-    df.to_excel(filename, index=False)
+
+    with pd.ExcelWriter(filename) as writer:
+        pd.DataFrame(data, columns=['Repository', 'Prefix', 'Last Commit Date']).to_excel(
+            writer, sheet_name='Undefined', index=False)
+        pd.DataFrame(newly_undefined, columns=['Repository', 'Prefix', 'Last Commit Date']).to_excel(
+            writer, sheet_name='Newly undefined', index=False)
+        pd.DataFrame(newly_fixed, columns=['Repository', 'Prefix', 'Status']).to_excel(
+            writer, sheet_name='Newly fixed', index=False)
     logging.info(f"Excel file '{filename}' created successfully in 'output' directory.")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Report repositories with 'RepoOwner' set to 'undefined'.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of repository pages fetched concurrently (default: %(default)s)")
+    parser.add_argument("--state-file", default=STATE_FILE,
+                        help="state of the previous run, used for conditional requests and the diff "
+                             "(default: %(default)s)")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="re-query every repository; the report is still compared with the previous run")
+    return parser.parse_args()
+
+def report_row(name, entry):
+    return {
+        'Repository': name,
+        'Prefix': extract_prefix(name),
+        'Last Commit Date': format_commit_date(entry.get('last_commit_date'))
+    }
+
 def main():
+    args = parse_args()
     owner = "spring-media"
     token = os.getenv("GIT_API_KEY")
 
@@ -101,20 +127,70 @@ def main():
         logging.critical("GIT_API_KEY is not set. Please check your environment variables.")
         return
 
-    repositories = fetch_repositories(owner, token)
-    undefined_owners = []
+    last_run = load_state(args.state_file)
+    previous_state = last_run['repositories']
+    if last_run['updated_at']:
+        logging.info(f"Comparing with the state of {last_run['updated_at'].isoformat()}")
+    cached_state = {} if args.full_refresh else previous_state
+    property_pages = {} if args.full_refresh else last_run['property_pages']
+
+    try:
+        repositories = fetch_repositories(owner, token, args.workers)
+    except RepositoryListingError as e:
+        # A partial listing would overwrite the state and report the missing repositories as fixed
+        logging.critical(f"{e}. No report created, the state of the previous run is kept.")
+        return
+    repo_names = [repo['name'] for repo in repositories]
+
+    # A handful of paginated requests for all repositories instead of one request per repository
+    repo_owners = fetch_repo_owner_map(owner, token, property_pages)
+    if repo_owners is None:
+        logging.critical("Could not fetch the 'RepoOwner' property values. No report created.")
+        return
 
+    state = {}
     for repo in repositories:
-        if fetch_repo_owner_property(owner, repo['name'], token):
-            last_commit_date = fetch_last_commit(owner, repo['name'], token)
-            undefined_owners.append({
-                'Repository': repo['name'],
-                'Prefix': extract_prefix(repo['name']),
-                'Last Commit Date': last_commit_date
-            })
-
-    if undefined_owners:
-        create_excel(undefined_owners)
+        previous = cached_state.get(repo['name'])
+        state[repo['name']] = {
+            'pushed_at': repo.get('pushed_at'),
+            'updated_at': repo.get('updated_at'),
+            'repo_owner': repo_owners.get(repo['name']),
+            # The last commit only changes with a push, so the cached date stays valid until then
+            'last_commit_date': None if has_changed(repo, previous) else previous.get('last_commit_date'),
+        }
+    undefined_names = [name for name in repo_names if is_undefined(state[name]['repo_owner'])]
+    logging.info(f"{len(undefined_names)} of {len(repo_names)} repositories have 'RepoOwner' set to 'undefined'")
+
+    # Last commit dates for the affected repositories that changed, in a few batched GraphQL requests
+    stale_names = [name for name in undefined_names if not state[name]['last_commit_date']]
+    logging.info(f"Fetching last commits of {len(stale_names)} of {len(undefined_names)} undefined repositories")
+    metadata = fetch_repositories_metadata([f"{owner}/{name}" for name in stale_names], token)
+    for name in stale_names:
+        state[name]['last_commit_date'] = metadata.get(f"{owner}/{name}", {}).get('last_commit_date')
+
+    undefined_owners = [report_row(name, state[name]) for name in undefined_names]
+
+    # Changes since the previous run; there is nothing to compare against on the first run
+    newly_undefined, newly_fixed = [], []
+    if previous_state:
+        newly_undefined = [report_row(name, state[name]) for name in undefined_names
+                           if not is_undefined(previous_state.get(name, {}).get('repo_owner'))]
+        for name, entry in previous_state.items():
+            if is_undefined(entry.get('repo_owner')) and not is_undefined(state.get(name, {}).get('repo_owner')):
+                if name not in state:
+                    status = "Archived or deleted"
+                elif state[name]['repo_owner'] is None:
+                    status = "RepoOwner removed"
+                else:
+                    status = f"RepoOwner set to {state[name]['repo_owner']}"
+                newly_fixed.append({'Repository': name, 'Prefix': extract_prefix(name), 'Status': status})
+        logging.info(f"Since the previous run: {len(newly_undefined)} newly undefined, "
+                     f"{len(newly_fixed)} newly fixed repositories")
+
+    save_state(args.state_file, state, property_pages)
+
+    if undefined_owners or newly_fixed:
+        create_excel(undefined_owners, newly_undefined, newly_fixed)
     else:
         logging.info("No repositories with 'RepoOwner' set to 'undefined' were found.")
 
@@ -3,62 +3,546 @@ import json
 import csv
 import sys
 import os
+import argparse
+import gzip
+import mmap
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 from pathlib import Path
 
-# Function to check if the file is a JSON file
-def is_json_file(file_path):
+# Use orjson for NDJSON records when it is installed, it decodes several times faster
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Size of the blocks read from the input file; objects larger than this are handled by growing the buffer
+CHUNK_SIZE = 1 << 20
+
+# Largest single array element the buffer may grow to before the input is rejected
+MAX_VALUE_SIZE = 256 << 20
+
+# A decode error this close to the end of the buffer may be a token cut by the block boundary
+# (a literal like 'fals', a number's exponent, a \uXXXX escape), so it is retried with more data
+INCOMPLETE_TOKEN_MARGIN = 16
+
+# Number of chunks per worker in parallel mode, so a slow chunk doesn't leave the other workers idle
+CHUNKS_PER_WORKER = 4
+
+# Rows per Parquet row group / Arrow record batch; bounds the memory used for columnar output
+BATCH_SIZE = 65536
+
+# Output formats and CSV compressions inferred from the output file extension
+FORMAT_EXTENSIONS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Raised when the input is not a JSON array (or not valid JSON at all)
+class InvalidJSONError(ValueError):
+    pass
+
+# Raised when valid JSON can't be written in the requested output format
+class ConversionError(ValueError):
+    pass
+
+# Function to skip whitespace in the buffer, starting at pos
+def skip_whitespace(buffer, pos):
+    while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+        pos += 1
+    return pos
+
+# Generator that yields the elements of a top-level JSON array one at a time,
+# validating the document while reading it block by block
+def iter_json_array(file, chunk_size=CHUNK_SIZE, max_value_size=MAX_VALUE_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size)
+    eof = not buffer
+    pos = skip_whitespace(buffer, 0)
+
+    def fill(pos, min_size=chunk_size):
+        # Drop the consumed part and append the next block; returns (buffer, pos, eof)
+        data = file.read(max(chunk_size, min_size))
+        return buffer[pos:] + data, 0, not data
+
+    while pos == len(buffer) and not eof:
+        buffer, pos, eof = fill(pos)
+    if pos == len(buffer) or buffer[pos] != '[':
+        raise InvalidJSONError("Expected a JSON array at the top level")
+    pos += 1
+
+    expect_value = True
+    first = True
+    while True:
+        pos = skip_whitespace(buffer, pos)
+        if pos == len(buffer):
+            if eof:
+                raise InvalidJSONError("Unexpected end of file inside the JSON array")
+            buffer, pos, eof = fill(pos)
+            continue
+
+        char = buffer[pos]
+        if char == ']' and (first or not expect_value):
+            pos += 1
+            break
+        if not expect_value:
+            if char != ',':
+                raise InvalidJSONError(f"Expected ',' or ']' but found {char!r}")
+            pos += 1
+            expect_value = True
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            # Only an error at the end of the buffer (or a string that isn't closed yet) means the
+            # value continues in the next block; anything else is a syntax error in the file
+            incomplete = (e.pos >= len(buffer) - INCOMPLETE_TOKEN_MARGIN
+                          or e.msg.startswith('Unterminated string'))
+            if eof or not incomplete:
+                raise InvalidJSONError(str(e)) from e
+            if len(buffer) - pos > max_value_size:
+                raise InvalidJSONError(f"An array element is larger than {max_value_size} bytes "
+                                       f"or not terminated: {e}") from e
+            # Read at least as much again, so a large value needs only a few reads
+            buffer, pos, eof = fill(pos, len(buffer) - pos)
+            continue
+        if end == len(buffer) and not eof:
+            # A number at the end of the buffer may continue in the next block
+            buffer, pos, eof = fill(pos)
+            continue
+
+        yield value
+        pos = end
+        expect_value = False
+        first = False
+        if pos > chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+    # Only whitespace may follow the closing bracket
+    while True:
+        pos = skip_whitespace(buffer, pos)
+        if pos < len(buffer):
+            raise InvalidJSONError(f"Unexpected data after the JSON array: {buffer[pos]!r}")
+        if eof:
+            return
+        buffer, pos, eof = fill(pos)
+
+# Function to detect whether a file holds a JSON array ('json') or one object per line ('ndjson')
+def detect_format(file_path):
+    with open(file_path, 'rb') as file:
+        while True:
+            block = file.read(4096)
+            if not block:
+                raise InvalidJSONError("The input file is empty")
+            stripped = block.lstrip()
+            if stripped:
+                return 'json' if stripped[:1] == b'[' else 'ndjson'
+
+# Generator that yields the objects of an NDJSON file (binary mode), skipping blank lines
+def iter_ndjson(lines):
+    for line in lines:
+        if line.strip():
+            try:
+                yield loads(line)
+            except ValueError as e:
+                raise InvalidJSONError(str(e)) from e
+
+# Function to split a file into byte ranges that start and end at line boundaries.
+# The file is memory-mapped, so finding the split points doesn't copy any data.
+def find_line_chunks(file_path, count):
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return []
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        boundaries = [0]
+        for i in range(1, count):
+            pos = mm.find(b'\n', max(size * i // count, boundaries[-1]))
+            if pos == -1:
+                break
+            if pos + 1 > boundaries[-1]:
+                boundaries.append(pos + 1)
+        if boundaries[-1] != size:
+            boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+# Generator that yields the lines of a byte range of a file
+def iter_range_lines(file_path, start, end):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                return
+            yield line
+
+# Function to flatten nested objects into a single level dict with dotted keys.
+# Lists are JSON encoded ('json'), joined with ';' ('join') or expanded into indexed keys ('expand')
+def flatten(value, lists='json', prefix=''):
+    flat = {}
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list) and lists == 'expand':
+        items = enumerate(value)
+    else:
+        if isinstance(value, list):
+            if lists == 'join':
+                value = ';'.join('' if v is None else v if isinstance(v, str) else json.dumps(v) for v in value)
+            else:
+                value = json.dumps(value)
+        return {prefix: value}
+
+    for key, nested in items:
+        key = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(nested, (dict, list)):
+            if not nested and (isinstance(nested, dict) or lists == 'expand'):
+                # keep empty containers as a column instead of dropping them
+                flat[key] = json.dumps(nested)
+            else:
+                flat.update(flatten(nested, lists, key))
+        else:
+            flat[key] = nested
+    return flat
+
+# Function to add the keys of a row to the header, keeping first-seen order
+def extend_header(header, row):
+    for key in row:
+        if key not in header:
+            header[key] = None
+
+# Function to write flattened rows with a header that is the union of all keys.
+# With sample > 0 the header is taken from the first `sample` rows (kept in memory) and
+# keys that only appear later are dropped; otherwise rows are spilled to a temporary
+# NDJSON file while the header is collected and written out in a second pass over that file.
+def write_flat_rows(rows, file, sample=0):
+    header = {}
+    if sample > 0:
+        sampled = list(islice(rows, sample))
+        for row in sampled:
+            extend_header(header, row)
+        rows = chain(sampled, rows)
+        dropped = set()
+        csv_writer = csv.DictWriter(file, fieldnames=list(header), restval='', extrasaction='ignore')
+        csv_writer.writeheader()
+        for row in rows:
+            dropped.update(key for key in row if key not in header)
+            csv_writer.writerow(row)
+        if dropped:
+            print(f"WARNING: {len(dropped)} keys not seen in the first {sample} objects were dropped: "
+                  f"{', '.join(sorted(dropped)[:10])}", file=sys.stderr)
+        return
+
+    with tempfile.TemporaryFile('w+', newline='') as spill:
+        for row in rows:
+            extend_header(header, row)
+            spill.write(json.dumps(row) + '\n')
+        if not header:
+            return
+        spill.seek(0)
+        csv_writer = csv.DictWriter(file, fieldnames=list(header), restval='')
+        csv_writer.writeheader()
+        for line in spill:
+            csv_writer.writerow(json.loads(line))
+
+# Function to write the values of each object in the order of the first object's keys
+def write_rows(objects, file):
+    csv_writer = csv.writer(file)
+    count = 0
+    for d in objects:
+        if count == 0:
+            # Write header (keys of the JSON object) to the CSV file
+            header = d.keys()
+            csv_writer.writerow(header)
+            count += 1
+
+        # Write values of the JSON object to the CSV file
+        csv_writer.writerow(d.values())
+
+# Function to convert one byte range of an NDJSON file into a partial CSV without header.
+# Runs in a worker process; returns the column order of the partial (flat) or None.
+def convert_chunk(json_file_path, start, end, partial_path, flat=False, lists='json'):
+    objects = iter_ndjson(iter_range_lines(json_file_path, start, end))
+    with open(partial_path, 'w', newline='') as file:
+        csv_writer = csv.writer(file)
+        if not flat:
+            for d in objects:
+                csv_writer.writerow(d.values())
+            return None
+
+        # Rows of this chunk are spilled until its own header (union of its keys) is known
+        chunk_header = {}
+        with tempfile.TemporaryFile('w+', newline='') as spill:
+            for d in objects:
+                row = flatten(d, lists)
+                extend_header(chunk_header, row)
+                spill.write(json.dumps(row) + '\n')
+            spill.seek(0)
+            csv_writer = csv.DictWriter(file, fieldnames=list(chunk_header), restval='')
+            for line in spill:
+                csv_writer.writerow(json.loads(line))
+        return list(chunk_header)
+
+# Function to convert an NDJSON file with a process pool. The input is split at line
+# boundaries, chunks are converted in parallel and the partial CSVs are concatenated in order.
+# With flat=True the header is the union of the chunk headers; partials with a different
+# column order are remapped while concatenating, all others are copied byte for byte.
+def json2csv_parallel(json_file_path, output, workers, flat=False, lists='json', tmp_dir=None):
+    chunks = find_line_chunks(json_file_path, workers * CHUNKS_PER_WORKER)
+    if not chunks:
+        return
+
+    if not flat:
+        # Header (keys of the first JSON object), the partials only contain values
+        first = next(iter_ndjson(iter_range_lines(json_file_path, *chunks[0])), None)
+        if first is None:
+            return
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_dir:
+        partial_paths = [os.path.join(tmp_dir, f"part-{i:05d}.csv") for i in range(len(chunks))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(convert_chunk, json_file_path, start, end, partial_path, flat, lists)
+                       for (start, end), partial_path in zip(chunks, partial_paths)]
+            chunk_headers = [future.result() for future in futures]
+
+        if flat:
+            header = {}
+            for chunk_header in chunk_headers:
+                for key in chunk_header:
+                    header.setdefault(key, None)
+            header = list(header)
+            if not header:
+                return
+        else:
+            header = list(first.keys())
+
+        csv.writer(output).writerow(header)
+        output.flush()
+        for partial_path, chunk_header in zip(partial_paths, chunk_headers):
+            if not flat or chunk_header == header:
+                with open(partial_path, 'rb') as partial:
+                    shutil.copyfileobj(partial, output.buffer)
+                output.buffer.flush()
+                continue
+            with open(partial_path, newline='') as partial:
+                csv_writer = csv.DictWriter(output, fieldnames=header, restval='')
+                for values in csv.reader(partial):
+                    csv_writer.writerow(dict(zip(chunk_header, values)))
+            output.flush()
+
+# Generator that groups rows into lists of at most `size` rows
+def batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+# Function to infer the Arrow type of one column of a batch; values Arrow can't put in a
+# single column (e.g. ints mixed with strings, ints beyond 64 bits) make it a string column
+def infer_column_type(pa, values):
     try:
-        with open(file_path, 'r') as file:
-            json.load(file)
-        return True
-    except (ValueError, json.JSONDecodeError):
+        return pa.array(values).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return pa.string()
+
+# Function to combine the types a column has in two batches: null takes the other type, numbers
+# and structs are promoted (int -> double, union of struct fields), anything else becomes a string
+def widen_type(pa, current, new):
+    if current is None or pa.types.is_null(current):
+        return new
+    if pa.types.is_null(new) or current.equals(new):
+        return current
+    try:
+        schema = pa.unify_schemas([pa.schema([('value', current)]), pa.schema([('value', new)])],
+                                  promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        return pa.string()
+    return schema.field('value').type
+
+# Function to check for types Parquet can't store: structs without fields (from empty objects)
+# and columns that were null in every row
+def is_storable_type(pa, value_type):
+    if pa.types.is_null(value_type):
         return False
+    if pa.types.is_struct(value_type):
+        return value_type.num_fields > 0 and all(is_storable_type(pa, value_type.field(i).type)
+                                                 for i in range(value_type.num_fields))
+    if pa.types.is_list(value_type) or pa.types.is_large_list(value_type):
+        return is_storable_type(pa, value_type.value_type)
+    return True
 
-# Function to convert JSON data to CSV and save it to the output file
-def json2csv(json_file_path, csv_file_path):
-    # Load JSON data from the input file
-    with open(json_file_path) as data:
-        data = json.load(data)
+# Function to turn a value of a column widened to string into text; nested values and numbers
+# are written as JSON, like the CSV output does for lists
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
 
-    # Write JSON data to the output CSV file
-    with open(csv_file_path, 'w') as file:
-        csv_writer = csv.writer(file)
-        count = 0
-        for d in data:
-            if count == 0:
-                # Write header (keys of the JSON object) to the CSV file
-                header = d.keys()
-                csv_writer.writerow(header)
-                count += 1
-
-            # Write values of the JSON object to the CSV file
-            csv_writer.writerow(d.values())
-
-# Check if the correct number of arguments is provided
-if len(sys.argv) != 3:
-    print("ERROR: Need 2 arguments")
-    print("Usage: ./json2csv.py <input json file> <output csv filename>")
-    sys.exit()
-
-# Normalize and validate the input JSON file path
-json_file_path = sys.argv[1]
-normalized_json_path = os.path.normpath(json_file_path)
-base_json_path = Path(normalized_json_path).resolve(strict=True)
-
-# Check if the input JSON file is valid and exists
-if not (base_json_path.is_file() and not base_json_path.is_symlink() and is_json_file(normalized_json_path)):
-    print("ERROR: The input file is not a valid JSON file or the file does not exist.")
-    sys.exit()
-
-# Normalize the output CSV file path
-csv_file_path = sys.argv[2]
-normalized_csv_path = os.path.normpath(csv_file_path)
-base_csv_path = Path(normalized_csv_path).resolve(strict=False)
-
-# Check if the output CSV file path is not a symlink
-if base_csv_path.is_symlink():
-    print("ERROR: The output file path is a symlink.")
-    sys.exit()
-
-# Call the json2csv function to convert JSON data to CSV
-json2csv(normalized_json_path, normalized_csv_path)
\ No newline at end of file
+# Function to write rows as Parquet or Arrow IPC, one row group / record batch per BATCH_SIZE rows.
+# Like write_flat_rows, rows are spilled to a temporary NDJSON file while the schema is collected:
+# the union of all keys, with each column's type widened over all batches (columns that are
+# only null or hold empty objects become strings). The second pass over the spill file writes the batches.
+def write_columnar(rows, path, file_format, batch_size=BATCH_SIZE):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ConversionError(f"Writing {file_format} needs pyarrow: pip install pyarrow")
+
+    types = {}
+    with tempfile.TemporaryFile('w+', newline='') as spill:
+        for batch in batched(rows, batch_size):
+            header = {}
+            for row in batch:
+                extend_header(header, row)
+                spill.write(json.dumps(row) + '\n')
+            for key in header:
+                types[key] = widen_type(pa, types.get(key), infer_column_type(pa, [row.get(key) for row in batch]))
+        if not types:
+            # No rows: like the CSV output, produce an empty file
+            open(path, 'wb').close()
+            return
+
+        schema = pa.schema([(key, value_type if is_storable_type(pa, value_type) else pa.string())
+                            for key, value_type in types.items()])
+        text_columns = {field.name for field in schema if pa.types.is_string(field.type)}
+        spill.seek(0)
+        writer = pq.ParquetWriter(path, schema) if file_format == 'parquet' else pa.ipc.new_file(path, schema)
+        try:
+            for batch in batched((loads(line) for line in spill), batch_size):
+                columns = {field.name: [to_text(row.get(field.name)) if field.name in text_columns
+                                        else row.get(field.name) for row in batch] for field in schema}
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ConversionError(f"The rows couldn't be converted to {file_format}: {e}")
+        finally:
+            writer.close()
+
+# Function to open the (temporary) CSV output, optionally gzip or zstd compressed
+def open_csv_output(path, compression=None):
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', newline='')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ConversionError("Writing zstd compressed CSV needs zstandard: pip install zstandard")
+        return zstandard.open(path, 'wt', newline='')
+    return open(path, 'w', newline='')
+
+# Function to infer the output format and CSV compression from the output file name
+def output_type_from_path(path):
+    name, extension = os.path.splitext(path.lower())
+    if extension in FORMAT_EXTENSIONS:
+        return FORMAT_EXTENSIONS[extension], None
+    return 'csv', COMPRESSION_EXTENSIONS.get(extension)
+
+# Function to convert JSON data to CSV and save it to the output file.
+# The input is parsed and validated in a single streaming pass and rows are written as each
+# object is decoded; the output is written to a temporary file and only moved into place
+# once the whole input turned out to be valid. NDJSON input (one object per line) can be
+# converted by several worker processes. Instead of CSV, the output can be gzip/zstd
+# compressed CSV, Parquet or Arrow IPC (by default inferred from the output extension).
+def json2csv(json_file_path, csv_file_path, flat=False, lists='json', sample=0, workers=1,
+             file_format=None, compression=None):
+    inferred_format, inferred_compression = output_type_from_path(csv_file_path)
+    file_format = file_format or inferred_format
+    if file_format == 'csv':
+        compression = compression or inferred_compression
+
+    tmp_csv_path = f"{csv_file_path}.tmp"
+    try:
+        input_format = detect_format(json_file_path)
+        parallel = workers > 1 and input_format == 'ndjson' and file_format == 'csv'
+        if workers > 1 and not parallel:
+            print("WARNING: Parallel conversion needs NDJSON input and CSV output, converting in a single process.",
+                  file=sys.stderr)
+        if sample > 0 and flat and (parallel or file_format != 'csv'):
+            print("WARNING: --sample only applies to single-process CSV output, the header is taken from all objects.",
+                  file=sys.stderr)
+
+        if parallel:
+            with open_csv_output(tmp_csv_path, compression) as file:
+                json2csv_parallel(json_file_path, file, workers, flat, lists,
+                                  os.path.dirname(os.path.abspath(csv_file_path)))
+        else:
+            with open(json_file_path, 'rb' if input_format == 'ndjson' else 'r') as data:
+                objects = iter_json_array(data) if input_format == 'json' else iter_ndjson(data)
+                if flat:
+                    objects = (flatten(d, lists) for d in objects)
+                if file_format != 'csv':
+                    write_columnar(objects, tmp_csv_path, file_format)
+                else:
+                    with open_csv_output(tmp_csv_path, compression) as file:
+                        if flat:
+                            write_flat_rows(objects, file, sample)
+                        else:
+                            write_rows(objects, file)
+    except (InvalidJSONError, AttributeError, UnicodeDecodeError):
+        if os.path.exists(tmp_csv_path):
+            os.remove(tmp_csv_path)
+        raise InvalidJSONError("The input file is not a valid JSON array of objects")
+    except ConversionError:
+        if os.path.exists(tmp_csv_path):
+            os.remove(tmp_csv_path)
+        raise
+    os.replace(tmp_csv_path, csv_file_path)
+
+def main():
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description="Convert a JSON array of objects (or NDJSON) to CSV.",
+                                     usage="./json2csv.py <input json file> <output csv filename> [options]")
+    parser.add_argument("json_file_path", help="input JSON file")
+    parser.add_argument("csv_file_path", help="output CSV file")
+    parser.add_argument("--flatten", action="store_true",
+                        help="flatten nested objects into dotted columns; the header is the union of all keys")
+    parser.add_argument("--lists", choices=["json", "join", "expand"], default="json",
+                        help="with --flatten: encode lists as JSON, join them with ';' or expand them into "
+                             "indexed columns (default: %(default)s)")
+    parser.add_argument("--format", choices=["csv", "parquet", "arrow"],
+                        help="output format, inferred from the output extension by default "
+                             "(.parquet, .arrow/.feather, anything else is CSV)")
+    parser.add_argument("--compression", choices=["gzip", "zstd"],
+                        help="compress CSV output, inferred from a .gz/.zst output extension by default")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="convert NDJSON input with N worker processes (default: %(default)s)")
+    parser.add_argument("--sample", type=int, default=0,
+                        help="with --flatten: take the header from the first N objects instead of spilling "
+                             "all rows to a temporary file (keys first seen later are dropped)")
+    args = parser.parse_args()
+
+    # Normalize and validate the input JSON file path
+    json_file_path = args.json_file_path
+    normalized_json_path = os.path.normpath(json_file_path)
+    base_json_path = Path(normalized_json_path).resolve(strict=True)
+
+    # Check if the input JSON file exists (its content is validated while converting)
+    if not (base_json_path.is_file() and not base_json_path.is_symlink()):
+        print("ERROR: The input file is not a valid JSON file or the file does not exist.")
+        sys.exit()
+
+    # Normalize the output CSV file path
+    csv_file_path = args.csv_file_path
+    normalized_csv_path = os.path.normpath(csv_file_path)
+    base_csv_path = Path(normalized_csv_path).resolve(strict=False)
+
+    # Check if the output CSV file path is not a symlink
+    if base_csv_path.is_symlink():
+        print("ERROR: The output file path is a symlink.")
+        sys.exit()
+
+    # Call the json2csv function to convert JSON data to CSV
+    try:
+        json2csv(normalized_json_path, normalized_csv_path, args.flatten, args.lists, args.sample, args.workers,
+                 args.format, args.compression)
+    except InvalidJSONError:
+        print("ERROR: The input file is not a valid JSON file or the file does not exist.")
+        sys.exit()
+    except ConversionError as e:
+        print(f"ERROR: {e}")
+        sys.exit()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
-import requests
+import argparse
+import csv
+import json
 import os
+import sys
+import time
 from dotenv import load_dotenv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.github_properties import MAX_PROPERTY_UPDATE_REPOSITORIES, update_org_property_values
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -14,7 +22,7 @@ def update_custom_properties(owner, repo, token, properties):
     }
     payload = {"properties": properties}
 
-    response = requests.patch(url, headers=headers, json=payload)
+    response = http_client.patch(url, headers=headers, json=payload, idempotent=True)
     if response.status_code == 204:
         print(f"Properties updated successfully for {repo}.")
     elif response.status_code == 200:
@@ -24,10 +32,102 @@ def update_custom_properties(owner, repo, token, properties):
         print("Response headers:", response.headers)
         print("Response body:", response.json())
 
+def load_property_mapping(path):
+    """Read a repository -> value mapping from a JSON object ({"repo": "value"}) or a CSV file
+    with the columns 'repository' and 'value'."""
+    with open(path, newline='') as file:
+        if path.lower().endswith('.json'):
+            return json.load(file)
+        return {row['repository'].strip(): row['value'].strip() for row in csv.DictReader(file)
+                if row.get('repository')}
+
+def group_by_value(mapping):
+    """Group the repositories sharing the same value, so each group can be written with one request per batch."""
+    groups = {}
+    for repo, value in mapping.items():
+        groups.setdefault(value, []).append(repo)
+    return groups
+
+def build_batches(mapping, batch_size=MAX_PROPERTY_UPDATE_REPOSITORIES):
+    """Split the mapping into (value, repositories) batches of at most `batch_size` repositories."""
+    batches = []
+    # JSON null clears the property; None sorts after the values so mixed mappings don't fail to sort
+    for value, repos in sorted(group_by_value(mapping).items(), key=lambda item: (item[0] is None, item[0] or "")):
+        repos = sorted(repos)
+        for i in range(0, len(repos), batch_size):
+            batches.append((value, repos[i:i + batch_size]))
+    return batches
+
+def bulk_update_custom_properties(owner, token, mapping, property_name="RepoOwner",
+                                  batch_size=MAX_PROPERTY_UPDATE_REPOSITORIES, retries=3):
+    """Write a repository -> value mapping through the org-level endpoint, one request per batch.
+
+    Batches are sent one after another (GitHub's secondary rate limits punish concurrent writes);
+    batches that failed with a connection error, 429 or 5xx are retried with exponential backoff
+    after the first pass, other errors (e.g. 422 for an invalid value) fail at once.
+    Returns the list of (value, repositories) batches that still failed."""
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "X-GitHub-Api-Version": "2022-11-28"
+    }
+    batches = build_batches(mapping, batch_size)
+    print(f"Updating '{property_name}' on {len(mapping)} repositories in {len(batches)} batches.")
+
+    rejected = []
+
+    def send(number, value, repos):
+        """Send one batch; returns True if it should be retried."""
+        properties = [{"property_name": property_name, "value": value}]
+        success, retryable, detail = update_org_property_values(owner, headers, repos, properties)
+        if success:
+            print(f"Batch {number}/{len(batches)}: set '{value}' on {len(repos)} repositories.")
+            return False
+        print(f"Batch {number}/{len(batches)}: failed to set '{value}' on {len(repos)} repositories: {detail}")
+        if not retryable:
+            rejected.append((number, value, repos))
+        return retryable
+
+    failed = [(number, value, repos) for number, (value, repos) in enumerate(batches, start=1)
+              if send(number, value, repos)]
+
+    for attempt in range(retries):
+        if not failed:
+            break
+        time.sleep(2 ** attempt)
+        print(f"Retrying {len(failed)} failed batches (attempt {attempt + 1}/{retries})...")
+        failed = [(number, value, repos) for number, value, repos in failed if send(number, value, repos)]
+    failed = sorted(failed + rejected, key=lambda batch: batch[0])
+
+    updated = len(mapping) - sum(len(repos) for _, _, repos in failed)
+    print(f"\nSummary: {updated} of {len(mapping)} repositories updated, {len(failed)} batches failed.")
+    for number, value, repos in failed:
+        print(f"  Batch {number} ('{value}'): {', '.join(repos)}")
+    return [(value, repos) for _, value, repos in failed]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Set custom properties on GitHub repositories.")
+    parser.add_argument("mapping", nargs="?",
+                        help="CSV (columns 'repository', 'value') or JSON ({\"repo\": \"value\"}) file for bulk mode; "
+                             "without it the repositories listed in the script are updated one by one")
+    parser.add_argument("--property", default="RepoOwner", help="custom property to set (default: %(default)s)")
+    parser.add_argument("--owner", default="spring-media", help="GitHub organization (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=MAX_PROPERTY_UPDATE_REPOSITORIES,
+                        help="repositories per request, at most %(default)s")
+    parser.add_argument("--retries", type=int, default=3, help="retries for failed batches (default: %(default)s)")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    owner = "spring-media"
+    args = parse_args()
+    owner = args.owner
     token = os.getenv("GITHUB_TOKEN")
 
+    if args.mapping:
+        failed_batches = bulk_update_custom_properties(owner, token, load_property_mapping(args.mapping),
+                                                       args.property,
+                                                       min(max(args.batch_size, 1), MAX_PROPERTY_UPDATE_REPOSITORIES),
+                                                       args.retries)
+        sys.exit(1 if failed_batches else 0)
+
     repositories = [
         #Your repositories
     ]
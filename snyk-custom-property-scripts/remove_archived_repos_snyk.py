@@ -1,8 +1,14 @@
 import os
-import requests
+import sys
+import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.github_graphql import fetch_repositories_metadata
+
 load_dotenv()
 github_api_key = os.getenv("GIT_API_KEY")
 snyk_api_key = os.getenv("SNYK_API_KEY")
@@ -12,6 +18,14 @@ snyk_headers = {'Authorization': f'token {snyk_api_key}', 'Content-Type': 'appli
 
 GITHUB_ORG_NAME = "spring-media"
 
+# repositories per GraphQL query and number of queries in flight for the archived check
+GRAPHQL_CHUNK_SIZE = int(os.getenv("GITHUB_GRAPHQL_CHUNK_SIZE", "100"))
+GRAPHQL_WORKERS = int(os.getenv("GITHUB_GRAPHQL_WORKERS", "4"))
+
+# Snyk orgs processed in parallel and target deletions in flight across all orgs
+ORG_WORKERS = int(os.getenv("SNYK_ORG_WORKERS", "4"))
+DELETE_WORKERS = int(os.getenv("SNYK_DELETE_WORKERS", "4"))
+
 def load_org_mapping():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     file_path = os.path.join(script_dir, 'org_mapping.json')
@@ -29,7 +43,7 @@ def fetch_all_snyk_targets(org_id, headers):
 
     print(f"Fetching all targets in org '{org_id}'...")
     while targets_url:
-        response = requests.get(targets_url, headers=headers, params=params)
+        response = http_client.get(targets_url, headers=headers, params=params)
         if response.status_code == 200:
             data = response.json()
             all_targets.extend(data.get('data', []))
@@ -53,95 +67,102 @@ def fetch_all_snyk_targets(org_id, headers):
     return all_targets
 
 # batch-check archived status of repo
-def batch_check_archived_repos(repo_list, token):
-    url = "https://api.github.com/graphql"
-    headers = {"Authorization": f"Bearer {token}"}
-
-    queries = []
-    for i, repo in enumerate(repo_list):
-        owner, name = repo.split('/')
-        queries.append(f"""
-            repo{i}: repository(owner: "{owner}", name: "{name}") {{
-                nameWithOwner
-                isArchived
-            }}
-        """)
-    query = f"query {{ {' '.join(queries)} }}"
-
-    print(f"Executing batch query for {len(repo_list)} repositories...")
-    response = requests.post(url, headers=headers, json={"query": query})
-
-    if response.status_code == 200:
-        data = response.json()
-        result = {}
-        for key, value in data.get("data", {}).items():
-            if value:
-                result[value["nameWithOwner"]] = value["isArchived"]
-        return result
-    else:
-        print(f"GraphQL query failed: {response.status_code} - {response.text}")
-        return {}
+def batch_check_archived_repos(repo_list, token, chunk_size=GRAPHQL_CHUNK_SIZE, max_workers=GRAPHQL_WORKERS):
+    print(f"Executing batch queries for {len(repo_list)} repositories "
+          f"({chunk_size} per query, {max_workers} in parallel)...")
+    metadata = fetch_repositories_metadata(repo_list, token, chunk_size=chunk_size, max_workers=max_workers)
+    return {name: repo["archived"] for name, repo in metadata.items()}
 
-# remove a target from Snyk
+# remove a target from Snyk (the shared client backs off on rate limits and server errors)
 def remove_from_snyk(org_id, target_id):
     delete_url = f"https://api.snyk.io/rest/orgs/{org_id}/targets/{target_id}?version=2024-05-08"
 
     print(f"Attempting to remove target ID '{target_id}' from org '{org_id}'...")
-    response = requests.delete(delete_url, headers=snyk_headers)
+    response = http_client.delete(delete_url, headers=snyk_headers)
 
     if response.status_code == 204:
         print(f"Successfully removed target with ID '{target_id}' from Snyk organization '{org_id}'.")
+        return True
     elif response.status_code == 404:
         print(f"Failed: Target '{target_id}' not found.\n")
     else:
         print(f"Failed: Could not remove target '{target_id}' - {response.status_code}: {response.text}\n")
+    return False
+
+def process_org(org_name, org_details, delete_executor, dry_run=False):
+    """Find the archived repositories of one Snyk org and remove their targets.
+
+    Returns a tuple (archived_count, removed_count)."""
+    org_id = org_details["org_id"]
+    print(f"\nProcessing organization: {org_name} (Org ID: {org_id})")
+
+    # fetch all targets from Snyk for org & collect repo names to batch-check
+    all_targets = fetch_all_snyk_targets(org_id, snyk_headers)
+    repo_list = []
+    repo_to_target_id = {}
+
+    for target in all_targets:
+        display_name = target['attributes'].get('display_name')
+        target_id = target.get('id')
+
+        if not display_name or not target_id:
+            print(f"Missing data for target: display_name='{display_name}', target_id='{target_id}'")
+            continue
+
+        split_display_name = display_name.split('/')
+        if len(split_display_name) != 2:
+            print(f"Unexpected display name format: {display_name}")
+            continue
+
+        owner, repo_name = split_display_name
+        full_repo_name = f"{owner}/{repo_name}"
+        repo_list.append(full_repo_name)
+        repo_to_target_id[full_repo_name] = target_id
+
+    # batch-check archive status
+    archived_statuses = batch_check_archived_repos(repo_list, github_api_key)
+    archived_repos = [repo_name for repo_name, is_archived in archived_statuses.items() if is_archived]
+
+    if dry_run:
+        for repo_name in archived_repos:
+            print(f"[dry-run] Would remove {repo_name} (target ID '{repo_to_target_id[repo_name]}') from org '{org_name}'.")
+        return len(archived_repos), 0
+
+    for repo_name in archived_repos:
+        print(f"Confirmed archived: {repo_name}. Proceeding with removal.")
+    results = delete_executor.map(lambda repo_name: remove_from_snyk(org_id, repo_to_target_id[repo_name]),
+                                  archived_repos)
+    return len(archived_repos), sum(results)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Remove targets of archived GitHub repositories from Snyk.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report which targets would be removed")
+    parser.add_argument("--org-workers", type=int, default=ORG_WORKERS,
+                        help="number of Snyk orgs processed concurrently (default: %(default)s)")
+    parser.add_argument("--delete-workers", type=int, default=DELETE_WORKERS,
+                        help="number of concurrent target deletions (default: %(default)s)")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     selected_orgs = org_mapping.items()
-    archived_count = 0
-    removed_count = 0
-
-    for org_name, org_details in selected_orgs:
-        org_id = org_details["org_id"]
-        print(f"\nProcessing organization: {org_name} (Org ID: {org_id})")
-
-        # fetch all targets from Snyk for org & collect repo names to batch-check
-        all_targets = fetch_all_snyk_targets(org_id, snyk_headers)
-        repo_list = []
-        repo_to_target_id = {}
-
-        for target in all_targets:
-            display_name = target['attributes'].get('display_name')
-            target_id = target.get('id')
-
-            if not display_name or not target_id:
-                print(f"Missing data for target: display_name='{display_name}', target_id='{target_id}'")
-                continue
-
-            split_display_name = display_name.split('/')
-            if len(split_display_name) != 2:
-                print(f"Unexpected display name format: {display_name}")
-                continue
-
-            owner, repo_name = split_display_name
-            full_repo_name = f"{owner}/{repo_name}"
-            repo_list.append(full_repo_name)
-            repo_to_target_id[full_repo_name] = target_id
-
-        # batch-check archive status
-        archived_statuses = batch_check_archived_repos(repo_list, github_api_key)
-
-        for repo_name, is_archived in archived_statuses.items():
-            if is_archived:
-                archived_count += 1
-                print(f"Confirmed archived: {repo_name}. Proceeding with removal.")
-                target_id = repo_to_target_id[repo_name]
-                remove_from_snyk(org_id, target_id)
-                removed_count += 1
+
+    # One deletion pool shared by all orgs, so the load on Snyk stays bounded
+    with ThreadPoolExecutor(max_workers=max(args.delete_workers, 1)) as delete_executor, \
+            ThreadPoolExecutor(max_workers=max(args.org_workers, 1)) as org_executor:
+        results = list(org_executor.map(
+            lambda org: process_org(org[0], org[1], delete_executor, args.dry_run), selected_orgs))
+
+    archived_count = sum(archived for archived, _ in results)
+    removed_count = sum(removed for _, removed in results)
 
     print(f"\nSummary:")
     print(f"Total archived repositories found: {archived_count}")
-    print(f"Total removals performed: {removed_count}")
+    if args.dry_run:
+        print("Dry run: no targets were removed")
+    else:
+        print(f"Total removals performed: {removed_count}")
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,20 @@
-import requests
 import json
 import logging
 import os
+import sys
+import time
+import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from dotenv import load_dotenv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.github_graphql import fetch_repositories_metadata
+from common.github_properties import fetch_property_map
+from common.github_repositories import RepositoryListingError, iter_repositories, iter_repositories_created_since
+
 load_dotenv()
 logging.basicConfig(level=logging.DEBUG)
 
@@ -24,88 +35,351 @@ def load_org_mapping():
 
 org_mapping = load_org_mapping()
 
+# Optional on-disk cache of Snyk target names per org, reused by runs within the TTL
+SNYK_TARGET_CACHE_DIR = os.getenv("SNYK_TARGET_CACHE_DIR")
+SNYK_TARGET_CACHE_TTL = int(os.getenv("SNYK_TARGET_CACHE_TTL", 24 * 60 * 60))
+
+# Imports submitted concurrently and import job status requests per polling round (snyk.io requests are capped by the HTTP client)
+IMPORT_WORKERS = int(os.getenv("SNYK_IMPORT_WORKERS", "4"))
+# Import job polling: first delay, maximum delay and time limit for all jobs in seconds
+POLL_INITIAL_DELAY = 5
+POLL_MAX_DELAY = 60
+POLL_TIMEOUT = int(os.getenv("SNYK_IMPORT_POLL_TIMEOUT", 30 * 60))
+
+# High-water mark of the previous run (time, repository ids, RepoOwner values); incremental mode when set
+IMPORT_STATE_FILE = os.getenv("SNYK_IMPORT_STATE_FILE")
+# Repositories created this long before the previous run are listed again, in case of clock skew
+STATE_OVERLAP = datetime.timedelta(hours=1)
+
+# org_id -> set of target display names ("owner/repo"), filled once per org and run
+snyk_target_index = {}
+
 def fetch_all_snyk_targets(org_id, headers):
     all_targets = []
     targets_url = f"https://api.snyk.io/rest/orgs/{org_id}/targets"
     params = {'version': '2024-05-08', 'limit': 100, 'created_gte': '2022-01-01T16:00:00Z'}
     while targets_url:
-        response = requests.get(targets_url, headers=headers, params=params)
+        response = http_client.get(targets_url, headers=headers, params=params)
         if response.status_code == 200:
             data = response.json()
             all_targets.extend(data.get('data', []))
             targets_url = data.get('links', {}).get('next')
         else:
             logging.error(f"Failed to retrieve targets: {response.status_code} - {response.text}")
-            break
+            return None
         params = None
     return all_targets
 
+def target_cache_path(org_id, cache_dir):
+    return os.path.join(cache_dir, f"snyk_targets_{org_id}.json")
+
+def load_cached_target_names(org_id, cache_dir, ttl):
+    """Return the cached target names for an org, or None if there is no fresh cache."""
+    path = target_cache_path(org_id, cache_dir)
+    try:
+        with open(path) as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cache.get('fetched_at', 0) > ttl:
+        logging.info(f"Snyk target cache for org {org_id} is older than {ttl}s, refreshing.")
+        return None
+    return set(cache.get('display_names', []))
+
+def save_cached_target_names(org_id, cache_dir, names):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = target_cache_path(org_id, cache_dir)
+    with open(path, 'w') as file:
+        json.dump({'fetched_at': time.time(), 'display_names': sorted(names)}, file)
+
+def get_snyk_target_names(org_id, cache_dir=None, ttl=SNYK_TARGET_CACHE_TTL):
+    """Return the set of target display names for an org, listing Snyk at most once per run.
+    Returns None if the listing failed; the failure isn't cached, so the next call lists again."""
+    if org_id in snyk_target_index:
+        return snyk_target_index[org_id]
+
+    names = load_cached_target_names(org_id, cache_dir, ttl) if cache_dir else None
+    if names is not None:
+        logging.info(f"Using cached Snyk targets for org {org_id} ({len(names)} targets).")
+    else:
+        targets = fetch_all_snyk_targets(org_id, snyk_headers)
+        if targets is None:
+            # Without the listing every repository would look new, and Snyk re-runs the import
+            # of targets that already exist, so the org is skipped instead
+            return None
+        names = {target['attributes']['display_name'] for target in targets}
+        if cache_dir:
+            save_cached_target_names(org_id, cache_dir, names)
+
+    snyk_target_index[org_id] = names
+    return names
+
 def fetch_all_repositories(org, headers):
-    repositories = []
-    page = 1
-    while True:
-        repo_url = f"https://api.github.com/orgs/{org}/repos?type=all&per_page=100&page={page}"
-        response = requests.get(repo_url, headers=headers)
+    """Yield the unarchived repositories of the org; pages are fetched concurrently and streamed as they arrive."""
+    return iter_repositories(org, headers)
+
+def load_import_state(path):
+    """Load the high-water mark of the previous run, or None if there is none."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        logging.info(f"No import state found in '{path}', processing all repositories.")
+        return None
+
+def save_import_state(path, state):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
+
+def iter_changed_repositories(owner, state, repo_owners, unresolved=None):
+    """Yield the repositories created since the previous run, plus those whose RepoOwner changed
+    or whose import failed; the work follows the change set, not the org size.
+
+    Changed repositories whose metadata couldn't be fetched are appended to `unresolved`,
+    so the caller can keep them for the next run."""
+    since = datetime.datetime.strptime(state['last_run'], '%Y-%m-%dT%H:%M:%S%z') - STATE_OVERLAP
+    seen_ids = set(state.get('repo_ids', []))
+    new_names = set()
+    for repo in iter_repositories_created_since(owner, github_headers, since.strftime('%Y-%m-%dT%H:%M:%SZ')):
+        if repo['id'] not in seen_ids:
+            new_names.add(repo['name'])
+            yield repo
+
+    previous_owners = state.get('repo_owners', {})
+    changed_names = {name for name, value in repo_owners.items() if previous_owners.get(name) != value}
+    # Failed imports of repositories that no longer exist (not in the property map) aren't retried
+    changed_names = (changed_names | (set(state.get('failed', [])) & set(repo_owners))) - new_names
+    logging.info(f"{len(new_names)} new repositories, {len(changed_names)} with a changed RepoOwner or failed import")
+
+    # Default branch and archived flag of the changed repositories in a few batched GraphQL requests
+    metadata = fetch_repositories_metadata([f"{owner}/{name}" for name in sorted(changed_names)], github_api_key)
+    for name in sorted(changed_names):
+        repo = metadata.get(f"{owner}/{name}")
+        if repo is None:
+            logging.warning(f"No metadata for {name}, it is retried by the next run.")
+            if unresolved is not None:
+                unresolved.append(name)
+        elif not repo['archived']:
+            yield {'name': name, 'default_branch': repo['default_branch']}
+
+def check_repository_import(repo, repo_owner, owner, cache_dir=None):
+    """Return the pending import of a repository, or None if it is already in Snyk or its RepoOwner isn't mapped.
+    If the Snyk targets of the org can't be listed, the entry is returned as failed and isn't imported."""
+    repo_name = repo['name']
+    if repo_owner not in org_mapping:
+        logging.error(f"No Snyk organization mapped for RepoOwner: {repo_owner}")
+        return None
+    org_details = org_mapping[repo_owner]
+    target_names = get_snyk_target_names(org_details['org_id'], cache_dir)
+    if target_names is not None and f"{owner}/{repo_name}" in target_names:
+        logging.info(f"The repository {repo_name} is already integrated into Snyk under {repo_owner}.")
+        return None
+    entry = {
+        'repository': repo_name,
+        'repo_owner': repo_owner,
+        'org_id': org_details['org_id'],
+        'integration_id': org_details['integration_id'],
+        # The listing already has the default branch, so imports don't assume 'master'
+        'branch': repo.get('default_branch') or 'master',
+        'status': 'pending',
+        'detail': '',
+        'job_url': None,
+    }
+    if target_names is None:
+        logging.error(f"Skipping {repo_name}: the Snyk targets of {repo_owner} could not be listed.")
+        entry.update(status='failed', detail='Snyk target listing failed')
+    return entry
+
+def submit_import(entry, owner):
+    """Start the Snyk import of one repository and remember the import job URL from the Location header."""
+    import_url = f"https://snyk.io/api/v1/org/{entry['org_id']}/integrations/{entry['integration_id']}/import"
+    data = json.dumps({"target": {"owner": owner, "name": entry['repository'], "branch": entry['branch']}})
+    try:
+        import_response = http_client.post(import_url, headers=snyk_headers, data=data)
+    except requests.exceptions.RequestException as e:
+        entry.update(status='failed', detail=f"Import request failed: {e}")
+        return entry
+    if import_response.status_code == 201:
+        logging.info(f"Import of {entry['repository']} ({entry['branch']}) initiated successfully.")
+        entry['job_url'] = import_response.headers.get('Location')
+        if not entry['job_url']:
+            entry.update(status='submitted', detail='No import job URL returned')
+    else:
+        logging.error(f"Failed to import {entry['repository']}: {import_response.status_code} - {import_response.text}")
+        entry.update(status='failed', detail=f"{import_response.status_code} - {import_response.text}")
+    return entry
+
+def import_job_result(job):
+    """Map an import job response to (status, detail); status is None while the job is still running."""
+    if job.get('status') == 'pending':
+        return None, ''
+    failed_logs = [log.get('name', '') for log in job.get('logs', []) if log.get('status') == 'failed']
+    projects = [project for log in job.get('logs', []) for project in log.get('projects', [])]
+    if job.get('status') == 'complete' and not failed_logs:
+        return 'imported', f"{len(projects)} projects"
+    return 'failed', f"Import job {job.get('status')}" + (f": {', '.join(failed_logs)}" if failed_logs else '')
+
+def check_import_job(entry):
+    """Request the status of a submitted import job once; the entry is updated when the job finished."""
+    try:
+        response = http_client.get(entry['job_url'], headers=snyk_headers)
         if response.status_code == 200:
-            data = response.json()
-            if not data:
-                break
-            # Filter out archived repositories
-            active_repos = [repo for repo in data if not repo['archived']]
-            repositories.extend(active_repos)
-            page += 1
-        else:
-            logging.error(f"Failed to retrieve repositories: {response.status_code} - {response.text}")
-            break
-    return repositories
-
-
-def check_and_import_repository(repo_name, repo_owner, owner):
-    if repo_owner in org_mapping:
-        org_details = org_mapping[repo_owner]
-        org_id, integration_id = org_details['org_id'], org_details['integration_id']
-        all_targets = fetch_all_snyk_targets(org_id, snyk_headers)
-        project_exists = any(target['attributes']['display_name'] == f"{owner}/{repo_name}" for target in all_targets)
-        if project_exists:
-            logging.info(f"The repository {repo_name} is already integrated into Snyk under {repo_owner}.")
+            status, detail = import_job_result(response.json())
+            if status:
+                entry.update(status=status, detail=detail)
         else:
-            import_url = f'https://snyk.io/api/v1/org/{org_id}/integrations/{integration_id}/import'
-            data = json.dumps({"target": {"owner": owner, "name": repo_name, "branch": "master"}})
-            import_response = requests.post(import_url, headers=snyk_headers, data=data)
-            if import_response.status_code == 201:
-                logging.info(f"Import of {repo_name} initiated successfully.")
-            else:
-                logging.error(f"Failed to import {repo_name}: {import_response.status_code} - {import_response.text}")
-    else:
-        logging.error(f"No Snyk organization mapped for RepoOwner: {repo_owner}")
+            logging.warning(f"Polling the import of {entry['repository']} failed: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Polling the import of {entry['repository']} failed: {e}")
+    return entry
+
+def poll_import_jobs(entries, timeout=POLL_TIMEOUT, max_workers=IMPORT_WORKERS):
+    """Poll all submitted import jobs together with exponential backoff until they finish or time out.
+
+    Every round checks the jobs that are still pending concurrently, so the number of imports in
+    flight isn't limited by the number of workers."""
+    delay = POLL_INITIAL_DELAY
+    deadline = time.time() + timeout
+    pending = [entry for entry in entries if entry['job_url'] and entry['status'] == 'pending']
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        while pending:
+            time.sleep(delay)
+            list(executor.map(check_import_job, pending))
+            pending = [entry for entry in pending if entry['status'] == 'pending']
+            if pending:
+                logging.info(f"{len(pending)} import jobs still pending")
+            if pending and time.time() + delay > deadline:
+                for entry in pending:
+                    entry.update(status='unknown', detail=f"Import job still pending after {timeout}s")
+                break
+            delay = min(delay * 2, POLL_MAX_DELAY)
+
+def print_results_table(results):
+    """Print one line per repository with the outcome of its import."""
+    if not results:
+        logging.info("No repositories needed to be imported.")
+        return
+    columns = ['repository', 'repo_owner', 'branch', 'status', 'detail']
+    widths = {column: max(len(column), *(len(str(entry[column])) for entry in results)) for column in columns}
+    print("  ".join(column.upper().ljust(widths[column]) for column in columns).rstrip())
+    for entry in sorted(results, key=lambda entry: (entry['repo_owner'], entry['repository'])):
+        print("  ".join(str(entry[column]).ljust(widths[column]) for column in columns).rstrip())
+    counts = {}
+    for entry in results:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    print(f"\nSummary: {', '.join(f'{count} {status}' for status, count in sorted(counts.items()))}")
 
-def fetch_repo_owner_property(owner, repo, headers):
-    url = f"https://api.github.com/repos/{owner}/{repo}/properties/values"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        properties = response.json()
-        for property in properties:
-            if property['property_name'] == 'RepoOwner':
-                repo_owner_value = property['value']
-                if repo_owner_value.lower() == 'undefined':
-                    logging.info(f"'RepoOwner' property for {repo} is set to 'undefined'")
-                    return None
-                return repo_owner_value
+def write_results(results, path):
+    """Write the per-repository results as JSON for later runs or other tools."""
+    with open(path, 'w') as file:
+        json.dump([{key: value for key, value in entry.items() if key != 'integration_id'} for entry in results],
+                  file, indent=2)
+
+def fetch_repo_owner_property(repo, repo_owners):
+    """Look up the 'RepoOwner' property of a repository in the map built by fetch_property_map."""
+    repo_owner_value = repo_owners.get(repo)
+    if repo_owner_value is None:
         logging.info(f"'RepoOwner' property not found for {repo}")
-    else:
-        logging.error(f"Failed to fetch properties from GitHub: {response.status_code} - {response.text}")
-    return None
+        return None
+    if repo_owner_value.lower() == 'undefined':
+        logging.info(f"'RepoOwner' property for {repo} is set to 'undefined'")
+        return None
+    return repo_owner_value
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import GitHub repositories into Snyk based on their RepoOwner property.")
+    parser.add_argument("--cache-dir", default=SNYK_TARGET_CACHE_DIR,
+                        help="directory for the on-disk Snyk target cache (disabled if not set)")
+    parser.add_argument("--import-workers", type=int, default=IMPORT_WORKERS,
+                        help="imports submitted concurrently (default: %(default)s)")
+    parser.add_argument("--poll-timeout", type=int, default=POLL_TIMEOUT,
+                        help="seconds to wait for the import jobs to finish (default: %(default)s)")
+    parser.add_argument("--results", help="also write the per-repository results to this JSON file")
+    parser.add_argument("--state-file", default=IMPORT_STATE_FILE,
+                        help="high-water mark of the previous run; only new repositories and changed RepoOwner "
+                             "values are processed (disabled if not set)")
+    parser.add_argument("--full-resync", action="store_true",
+                        help="process every repository, e.g. for a reconciliation run, and reset the state")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     owner = 'spring-media'
-    repositories = fetch_all_repositories(owner, github_headers)
-    for repo in repositories:
-        repo_name = repo['name']
-        repo_owner = fetch_repo_owner_property(owner, repo_name, github_headers)
-        if repo_owner and repo_owner != 'undefined':
-            check_and_import_repository(repo_name, repo_owner, owner)
-        else:
-            logging.info(f"No 'RepoOwner' property found or set to 'undefined' for {repo_name}")
+    run_started = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    state = load_import_state(args.state_file) if args.state_file and not args.full_resync else None
+
+    # RepoOwner of every repository in a few paginated requests instead of one request per repository;
+    # in incremental mode unchanged pages are conditional requests answered with a free 304
+    property_pages = state.get('property_pages', {}) if state else {}
+    repo_owners = fetch_property_map(owner, github_headers, 'RepoOwner', property_pages)
+    if repo_owners is None:
+        logging.error("Failed to fetch the 'RepoOwner' property values from GitHub.")
+        return
+
+    # Changed repositories that couldn't be looked up; kept with the failed imports for the next run
+    unresolved = []
+    if state:
+        logging.info(f"Incremental run: processing changes since {state['last_run']}")
+        repositories = iter_changed_repositories(owner, state, repo_owners, unresolved)
+    else:
+        repositories = fetch_all_repositories(owner, github_headers)
+    repo_ids = set(state.get('repo_ids', [])) if state else set()
+
+    # Imports are submitted while the remaining repository pages are still being fetched;
+    # the import jobs are polled together afterwards, so slow jobs don't hold up other submissions
+    pending_by_org = {}
+    results = []
+    listing_failed = False
+    with ThreadPoolExecutor(max_workers=max(args.import_workers, 1)) as executor:
+        futures = []
+        try:
+            for repo in repositories:
+                repo_name = repo['name']
+                if 'id' in repo:
+                    repo_ids.add(repo['id'])
+                repo_owner = fetch_repo_owner_property(repo_name, repo_owners)
+                if repo_owner and repo_owner != 'undefined':
+                    entry = check_repository_import(repo, repo_owner, owner, args.cache_dir)
+                    if entry:
+                        results.append(entry)
+                    if entry and entry['status'] == 'pending':
+                        pending_by_org.setdefault(entry['org_id'], []).append(entry)
+                        futures.append(executor.submit(submit_import, entry, owner))
+                else:
+                    logging.info(f"No 'RepoOwner' property found or set to 'undefined' for {repo_name}")
+        except RepositoryListingError as e:
+            # Imports of the repositories listed so far still go ahead, but the state isn't advanced
+            logging.error(f"{e}. The import state of the previous run is kept.")
+            listing_failed = True
+        for future in futures:
+            future.result()
+    poll_import_jobs(results, args.poll_timeout, args.import_workers)
+
+    # Record the started imports per org, so later runs (and the cache) don't import them again
+    for org_id, entries in pending_by_org.items():
+        target_names = get_snyk_target_names(org_id, args.cache_dir)
+        started = [entry for entry in entries if entry['job_url'] or entry['status'] == 'submitted']
+        target_names.update(f"{owner}/{entry['repository']}" for entry in started)
+        if args.cache_dir and started:
+            save_cached_target_names(org_id, args.cache_dir, target_names)
+
+    print_results_table(results)
+    if args.results:
+        write_results(results, args.results)
+
+    if args.state_file and not listing_failed:
+        save_import_state(args.state_file, {
+            'last_run': run_started,
+            'repo_ids': sorted(repo_ids),
+            'repo_owners': repo_owners,
+            'property_pages': property_pages,
+            # Failed imports are retried by the next incremental run
+            'failed': sorted({entry['repository'] for entry in results if entry['status'] == 'failed'}
+                             | set(unresolved)),
+        })
 
 if __name__ == "__main__":
     main()
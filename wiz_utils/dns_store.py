@@ -0,0 +1,387 @@
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+'''Default location of the store, shared by fetch_aws_dns_delegations.py --store and the queries below'''
+DEFAULT_STORE = os.getenv("WIZ_DNS_STORE", "dns_delegations.sqlite")
+
+'''Property of Wiz DNS_RECORD entities holding the record data, for NS records the nameservers
+(a list, or a single string for one value). Records without it make the delegation report fail;
+`dns_store.py properties` lists the keys the stored NS records actually have.'''
+NAMESERVER_PROPERTY = "value"
+
+'''Nameservers of Route 53 hosted zones (ns-123.awsdns-45.com); a delegation to them without a
+matching zone can be taken over by anyone who creates a hosted zone with that name'''
+ROUTE53_NAMESERVER = re.compile(r"\.awsdns-\d+\.")
+
+'''Delegations are committed in batches of this size while a sweep streams in'''
+COMMIT_EVERY = 500
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        complete INTEGER NOT NULL DEFAULT 0,
+        records INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS zones (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        parent_name TEXT,
+        properties TEXT,
+        first_seen INTEGER NOT NULL,
+        last_seen INTEGER NOT NULL,
+        deleted_run INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS ns_records (
+        id TEXT PRIMARY KEY,
+        zone_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        properties TEXT,
+        first_seen INTEGER NOT NULL,
+        last_seen INTEGER NOT NULL,
+        deleted_run INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS record_nameservers (
+        record_id TEXT NOT NULL,
+        nameserver TEXT NOT NULL,
+        PRIMARY KEY (record_id, nameserver)
+    );
+    CREATE INDEX IF NOT EXISTS zones_name ON zones (name);
+    CREATE INDEX IF NOT EXISTS zones_parent_name ON zones (parent_name);
+    CREATE INDEX IF NOT EXISTS ns_records_zone_id ON ns_records (zone_id);
+    CREATE INDEX IF NOT EXISTS ns_records_name ON ns_records (name);
+    CREATE INDEX IF NOT EXISTS record_nameservers_nameserver ON record_nameservers (nameserver);
+"""
+
+
+class NameserverPropertyError(ValueError):
+    """NS records don't have the NAMESERVER_PROPERTY, so their nameservers can't be known."""
+
+
+def normalize_name(name):
+    """Lower-case a DNS name and drop the trailing dot, so 'Example.COM.' and 'example.com' match."""
+    return (name or "").strip().rstrip(".").lower()
+
+
+def parent_name(name):
+    """Return the parent domain of a DNS name ('a.example.com' -> 'example.com'), or None for a TLD."""
+    labels = normalize_name(name).split(".", 1)
+    return labels[1] if len(labels) == 2 and labels[1] else None
+
+
+def load_properties(properties):
+    """Return the properties of an entity as a dict, whether stored as JSON text or not."""
+    if isinstance(properties, str):
+        try:
+            properties = json.loads(properties)
+        except ValueError:
+            return {}
+    return properties if isinstance(properties, dict) else {}
+
+
+def has_nameserver_property(properties):
+    return NAMESERVER_PROPERTY in load_properties(properties)
+
+
+def extract_nameservers(properties):
+    """Return the sorted, normalized nameservers listed in the properties of an NS record."""
+    values = load_properties(properties).get(NAMESERVER_PROPERTY) or []
+    nameservers = set()
+    for value in values if isinstance(values, list) else [values]:
+        if isinstance(value, dict):
+            value = value.get("Value") or value.get("value") or ""
+        nameservers.update(normalize_name(part) for part in re.split(r"[\s,;]+", str(value)) if part)
+    nameservers.discard("")
+    return sorted(nameservers)
+
+
+class DnsStore:
+    """SQLite store of DNS zones, NS records and their nameservers, updated incrementally by each sweep.
+
+    Every sweep is a run: zones and records it sees are inserted or refreshed; after a complete
+    run, the ones it didn't see are marked deleted instead of being removed, so their history stays."""
+
+    def __init__(self, path=DEFAULT_STORE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.run_id = None
+        self.records = 0
+        # NS records of the current run without NAMESERVER_PROPERTY
+        self.unreadable = 0
+
+    def close(self):
+        self.db.close()
+
+    def begin_run(self):
+        self.run_id = self.db.execute("INSERT INTO runs (started_at) VALUES (?)", (time.time(),)).lastrowid
+        self.records = 0
+        self.unreadable = 0
+        self.db.commit()
+        return self.run_id
+
+    def add(self, delegation):
+        """Insert or refresh one zone / NS record pair as produced by iter_dns_delegations."""
+        if self.run_id is None:
+            self.begin_run()
+        zone_name = normalize_name(delegation.get("zone_name"))
+        if delegation.get("zone_id"):
+            self.db.execute(
+                """INSERT INTO zones (id, name, parent_name, properties, first_seen, last_seen)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET name = excluded.name, parent_name = excluded.parent_name,
+                       properties = excluded.properties, last_seen = excluded.last_seen, deleted_run = NULL""",
+                (delegation["zone_id"], zone_name, parent_name(zone_name),
+                 json.dumps(delegation.get("zone_properties")), self.run_id, self.run_id))
+        record_id = delegation["record_id"]
+        self.db.execute(
+            """INSERT INTO ns_records (id, zone_id, name, properties, first_seen, last_seen)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET zone_id = excluded.zone_id, name = excluded.name,
+                   properties = excluded.properties, last_seen = excluded.last_seen, deleted_run = NULL""",
+            (record_id, delegation.get("zone_id") or "", normalize_name(delegation.get("record_name")),
+             json.dumps(delegation.get("record_properties")), self.run_id, self.run_id))
+        self.db.execute("DELETE FROM record_nameservers WHERE record_id = ?", (record_id,))
+        self.db.executemany("INSERT INTO record_nameservers (record_id, nameserver) VALUES (?, ?)",
+                            [(record_id, nameserver)
+                             for nameserver in extract_nameservers(delegation.get("record_properties"))])
+        self.records += 1
+        if not has_nameserver_property(delegation.get("record_properties")):
+            self.unreadable += 1
+        if self.records % COMMIT_EVERY == 0:
+            self.db.commit()
+
+    def record(self, delegations):
+        """Pass delegations through unchanged while adding them to the store."""
+        for delegation in delegations:
+            self.add(delegation)
+            yield delegation
+
+    def finish_run(self, complete=True):
+        """Close the current run; a complete run marks the zones and records it didn't see as deleted."""
+        if complete:
+            for table in ("zones", "ns_records"):
+                self.db.execute(f"UPDATE {table} SET deleted_run = ? WHERE last_seen < ? AND deleted_run IS NULL",
+                                (self.run_id, self.run_id))
+        self.db.execute("UPDATE runs SET finished_at = ?, complete = ?, records = ? WHERE id = ?",
+                        (time.time(), int(complete), self.records, self.run_id))
+        self.db.commit()
+        self.run_id = None
+
+    def query(self, sql, parameters=()):
+        return [dict(row) for row in self.db.execute(sql, parameters)]
+
+    def zones(self, name):
+        """Active zones with the given name (public and private zones may share a name)."""
+        return self.query("SELECT * FROM zones WHERE name = ? AND deleted_run IS NULL", (normalize_name(name),))
+
+    def child_zones(self, name):
+        """Active zones directly below the given zone name."""
+        return self.query("SELECT * FROM zones WHERE parent_name = ? AND deleted_run IS NULL ORDER BY name",
+                          (normalize_name(name),))
+
+    def records_for_nameserver(self, nameserver):
+        """Active NS records pointing at a nameserver, with the zone they are defined in."""
+        return self.query(
+            """SELECT zones.name AS zone_name, ns_records.name AS record_name, ns_records.id AS record_id
+               FROM record_nameservers
+               JOIN ns_records ON ns_records.id = record_nameservers.record_id AND ns_records.deleted_run IS NULL
+               LEFT JOIN zones ON zones.id = ns_records.zone_id
+               WHERE record_nameservers.nameserver = ? ORDER BY zones.name, ns_records.name""",
+            (normalize_name(nameserver),))
+
+    def nameservers(self, record_id):
+        return [row["nameserver"] for row in
+                self.db.execute("SELECT nameserver FROM record_nameservers WHERE record_id = ? ORDER BY nameserver",
+                                (record_id,))]
+
+    def was_deleted(self, name):
+        """Whether the store has seen a zone with this name that is now marked deleted."""
+        return self.db.execute("SELECT 1 FROM zones WHERE name = ? AND deleted_run IS NOT NULL LIMIT 1",
+                               (normalize_name(name),)).fetchone() is not None
+
+    def property_keys(self):
+        """Count the property keys of the active NS records, to find the key that holds the nameservers."""
+        counts = {}
+        for row in self.db.execute("SELECT properties FROM ns_records WHERE deleted_run IS NULL"):
+            for key in load_properties(row["properties"]):
+                counts[key] = counts.get(key, 0) + 1
+        return [{"property": key, "records": count} for key, count in sorted(counts.items(), key=lambda item: -item[1])]
+
+    def reindex_nameservers(self):
+        """Extract the nameservers of all stored NS records again, e.g. after NAMESERVER_PROPERTY was changed."""
+        records = self.db.execute("SELECT id, properties FROM ns_records").fetchall()
+        self.db.execute("DELETE FROM record_nameservers")
+        self.db.executemany("INSERT INTO record_nameservers (record_id, nameserver) VALUES (?, ?)",
+                            [(row["id"], nameserver) for row in records
+                             for nameserver in extract_nameservers(row["properties"])])
+        self.db.commit()
+        return len(records)
+
+    def check_nameserver_property(self):
+        """Raise NameserverPropertyError if active NS records don't have NAMESERVER_PROPERTY."""
+        rows = self.db.execute("SELECT properties FROM ns_records WHERE deleted_run IS NULL").fetchall()
+        missing = [row for row in rows if not has_nameserver_property(row["properties"])]
+        if missing:
+            keys = sorted(set().union(*(load_properties(row["properties"]) for row in missing)))
+            raise NameserverPropertyError(
+                f"{len(missing)} of {len(rows)} NS records have no '{NAMESERVER_PROPERTY}' property "
+                f"(their properties: {', '.join(keys) or 'none'}); set NAMESERVER_PROPERTY to the key "
+                f"holding the nameservers and run 'reindex'")
+
+    def apex_nameservers(self, zone):
+        """The nameservers a zone is actually served by: the values of its own apex NS record."""
+        rows = self.db.execute(
+            """SELECT DISTINCT nameserver FROM record_nameservers
+               JOIN ns_records ON ns_records.id = record_nameservers.record_id
+               WHERE ns_records.zone_id = ? AND ns_records.name = ? AND ns_records.deleted_run IS NULL""",
+            (zone["id"], zone["name"]))
+        return {row["nameserver"] for row in rows}
+
+    def delegation_report(self):
+        """Check every delegation (an NS record below the apex of its zone) against the child zone.
+
+        Issues:
+        - dangling: the child zone was seen by an earlier run and is deleted now, or the delegation points
+          at Route 53 nameservers but no zone with that name is known
+        - external: the child zone isn't in the store and the nameservers aren't Route 53's, e.g. a
+          provider outside AWS; listed for review, not an issue by itself
+        - lame: the child zone exists, but none of the delegated nameservers serve it
+        - partial: only some of the delegated nameservers serve the child zone
+        - no nameservers: the record's NAMESERVER_PROPERTY is empty
+
+        Raises NameserverPropertyError if NS records don't have NAMESERVER_PROPERTY at all: their
+        nameservers are unknown, so every delegation would be reported wrongly."""
+        self.check_nameserver_property()
+        report = []
+        delegations = self.query(
+            """SELECT zones.name AS parent_zone, ns_records.id AS record_id, ns_records.name AS record_name
+               FROM ns_records JOIN zones ON zones.id = ns_records.zone_id
+               WHERE ns_records.deleted_run IS NULL AND zones.deleted_run IS NULL AND ns_records.name != zones.name
+               ORDER BY zones.name, ns_records.name""")
+        for delegation in delegations:
+            delegated = set(self.nameservers(delegation["record_id"]))
+            children = self.zones(delegation["record_name"])
+            detail = ""
+            if not delegated:
+                issue, served_by = "no nameservers", set()
+            elif not children:
+                served_by = set()
+                if self.was_deleted(delegation["record_name"]):
+                    issue, detail = "dangling", "child zone deleted"
+                elif any(ROUTE53_NAMESERVER.search(nameserver) for nameserver in delegated):
+                    issue, detail = "dangling", "no Route 53 zone with this name"
+                else:
+                    issue = "external"
+            else:
+                served_by = set().union(*(self.apex_nameservers(child) for child in children))
+                # A zone with several copies (e.g. private and public) is fine if one of them matches completely
+                if any(delegated and delegated <= self.apex_nameservers(child) for child in children):
+                    continue
+                issue = "partial" if delegated & served_by else "lame"
+            report.append({
+                "issue": issue,
+                "parent_zone": delegation["parent_zone"],
+                "record_name": delegation["record_name"],
+                "delegated_nameservers": " ".join(sorted(delegated)),
+                "child_zone_nameservers": " ".join(sorted(served_by)),
+                "detail": detail,
+            })
+        return report
+
+
+def load_ndjson(store, path):
+    """Load the NDJSON output of fetch_aws_dns_delegations.py into the store as one complete run."""
+    store.begin_run()
+    with (sys.stdin if path == "-" else open(path)) as file:
+        for line in file:
+            if line.strip():
+                store.add(json.loads(line))
+    store.finish_run(complete=True)
+    return store.records
+
+
+def write_rows(rows, output_format, output=sys.stdout):
+    if output_format == "ndjson":
+        for row in rows:
+            output.write(json.dumps(row) + "\n")
+        return
+    if not rows:
+        return
+    csv_writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+    csv_writer.writeheader()
+    csv_writer.writerows(rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the local store of DNS zones and NS delegations "
+                                                 "filled by fetch_aws_dns_delegations.py --store.")
+    parser.add_argument("-s", "--store", default=DEFAULT_STORE, help="SQLite store (default: %(default)s)")
+    parser.add_argument("-f", "--format", choices=["csv", "ndjson"], default="csv",
+                        help="output format (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("load", help="load NDJSON output of fetch_aws_dns_delegations.py as a run")
+    load.add_argument("input", help="NDJSON file, '-' for stdin")
+    commands.add_parser("dangling", help="report dangling, lame, partial and external delegations")
+    commands.add_parser("properties", help="count the property keys of the stored NS records")
+    commands.add_parser("reindex", help="extract the nameservers of the stored NS records again")
+    zone = commands.add_parser("zone", help="show a zone, its NS records and its child zones")
+    zone.add_argument("name")
+    nameserver = commands.add_parser("nameserver", help="list the NS records pointing at a nameserver")
+    nameserver.add_argument("name")
+    sql = commands.add_parser("sql", help="run a read-only SQL query against the store")
+    sql.add_argument("query")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store = DnsStore(args.store)
+    try:
+        if args.command == "load":
+            count = load_ndjson(store, args.input)
+            print(f"Loaded {count} DNS delegation records into {args.store}.", file=sys.stderr)
+        elif args.command == "dangling":
+            try:
+                report = store.delegation_report()
+            except NameserverPropertyError as e:
+                print(f"ERROR: {e}", file=sys.stderr)
+                sys.exit(1)
+            write_rows(report, args.format)
+            external = sum(1 for row in report if row["issue"] == "external")
+            print(f"{len(report) - external} delegations with issues, {external} to zones outside the store.",
+                  file=sys.stderr)
+        elif args.command == "properties":
+            write_rows(store.property_keys(), args.format)
+        elif args.command == "reindex":
+            count = store.reindex_nameservers()
+            print(f"Extracted the nameservers of {count} NS records.", file=sys.stderr)
+        elif args.command == "zone":
+            rows = []
+            for zone in store.zones(args.name):
+                for record in store.query("SELECT * FROM ns_records WHERE zone_id = ? AND deleted_run IS NULL "
+                                          "ORDER BY name", (zone["id"],)):
+                    rows.append({"zone_id": zone["id"], "zone_name": zone["name"], "record_name": record["name"],
+                                 "nameservers": " ".join(store.nameservers(record["id"]))})
+            write_rows(rows, args.format)
+            children = [child["name"] for child in store.child_zones(args.name)]
+            print(f"Child zones: {', '.join(children) or 'none'}", file=sys.stderr)
+        elif args.command == "nameserver":
+            write_rows(store.records_for_nameserver(args.name), args.format)
+        elif args.command == "sql":
+            store.db.execute("PRAGMA query_only = ON")
+            write_rows(store.query(args.query), args.format)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
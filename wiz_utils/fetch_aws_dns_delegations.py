@@ -1,10 +1,20 @@
-import base64
+import argparse
+import csv
 import json
 import requests
 import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from wiz_utils.dns_store import NAMESERVER_PROPERTY, DnsStore
+from wiz_utils.wiz_auth import request_wiz_api_token
 
 '''Wiz API credentials consist of client ID & Secret and Headers'''
-HEADERS_AUTH = {"Content-Type": "application/x-www-form-urlencoded"}
 HEADERS = {"Content-Type": "application/json"}
 CLIENT_ID = os.getenv("wiz-client-id")
 CLIENT_SECRET = os.getenv("wiz-client-secret")
@@ -128,17 +138,60 @@ QUERY = """
     }
 """
 
+'''Lists the Wiz projects, used to shard the graphSearch into one cursor chain per project'''
+PROJECTS_QUERY = """
+    query ProjectsTable($first: Int, $after: String) {
+      projects(first: $first, after: $after) {
+        nodes {
+          id
+          name
+        }
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
+      }
+    }
+"""
+
+'''Number of project shards queried concurrently in sharded mode'''
+SHARD_WORKERS = int(os.getenv("WIZ_SHARD_WORKERS", "4"))
+
+'''Named sets of expansion flags. "delegations" only fetches the zone and NS record entities,
+"exposure" adds public exposure, lateral movement and code source paths, which makes every page far more expensive.'''
+QUERY_PROFILES = {
+  "delegations": {
+    "quick": False,
+    "fetchPublicExposurePaths": False,
+    "fetchInternalExposurePaths": False,
+    "fetchIssueAnalytics": False,
+    "fetchLateralMovement": False,
+    "fetchCodeSource": False,
+    "fetchKubernetes": False,
+    "fetchCost": False,
+  },
+  "exposure": {
+    "quick": False,
+    "fetchPublicExposurePaths": True,
+    "fetchInternalExposurePaths": False,
+    "fetchIssueAnalytics": False,
+    "fetchLateralMovement": True,
+    "fetchCodeSource": True,
+    "fetchKubernetes": False,
+    "fetchCost": False,
+  },
+}
+DEFAULT_PROFILE = "delegations"
+
+'''Bounds for the adaptive page size: pages that time out are retried at half the size,
+pages answered within FAST_PAGE_SECONDS grow the size by half, up to MAX_PAGE_SIZE.'''
+MIN_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 500
+FAST_PAGE_SECONDS = 15
+
 '''Variables used in collaboration with the query, configure the search criteria, project IDs, pagination, number of results, etc.'''
 VARIABLES = {
-  "quick": False,
-  "fetchPublicExposurePaths": True,
-  "fetchInternalExposurePaths": False,
-  "fetchIssueAnalytics": False,
-  "fetchLateralMovement": True,
-  "fetchCodeSource": True,
-  "fetchKubernetes": False,
-  "fetchCost": False,
-  "first": 500,
+  "first": MAX_PAGE_SIZE,
   "query": {
     "relationships": [
       {
@@ -178,110 +231,346 @@ VARIABLES = {
   "fetchTotalCount": False
 }
 
-def query_wiz_api(query, variables, dc):
+def query_wiz_api(query, variables, dc, retry_timeouts=True):
     """This function Query Wiz API for the graphql query
     :param query: the grapql query used to fetch results
     :param variables: the configured query sent along with the query to fetch the results
-    :param dc: Value returned alongside the API token from Wiz that indicates which region, endpoint, or account context the token applies to."""
+    :param dc: Value returned alongside the API token from Wiz that indicates which region, endpoint, or account context the token applies to.
+    :param retry_timeouts: retry timed out requests unchanged; the adaptive pager retries with a smaller page instead"""
 
     data = {"variables": variables, "query": query}
 
     try:
-        result = requests.post(url=f"https://api.{dc}.app.wiz.io/graphql",
-                               json=data, headers=HEADERS, timeout=180)
+        result = http_client.post(url=f"https://api.{dc}.app.wiz.io/graphql",
+                                  json=data, headers=HEADERS, timeout=180, retry_timeouts=retry_timeouts,
+                                  idempotent=True)
+        if result.status_code == 401:
+            # the cached token was revoked or expired early, get a fresh one and retry once
+            print("Wiz token rejected, refreshing.", file=sys.stderr)
+            token, dc = request_wiz_api_token(CLIENT_ID, CLIENT_SECRET, force_refresh=True)
+            HEADERS["Authorization"] = "Bearer " + token
+            result = http_client.post(url=f"https://api.{dc}.app.wiz.io/graphql",
+                                      json=data, headers=HEADERS, timeout=180, retry_timeouts=retry_timeouts,
+                                      idempotent=True)
 
     except requests.exceptions.HTTPError as e:
-        print(f"<p>Wiz-API-Error (4xx/5xx): {str(e)}</p>")
+        print(f"<p>Wiz-API-Error (4xx/5xx): {str(e)}</p>", file=sys.stderr)
         return e
 
     except requests.exceptions.ConnectionError as e:
-        print(f"<p>Network problem (DNS failure, refused connection, etc): {str(e)}</p>")
+        print(f"<p>Network problem (DNS failure, refused connection, etc): {str(e)}</p>", file=sys.stderr)
         return e
 
     except requests.exceptions.Timeout as e:
-        print(f"<p>Request timed out: {str(e)}</p>")
+        print(f"<p>Request timed out: {str(e)}</p>", file=sys.stderr)
         return e
 
-    return result.json()
+    # gateway errors (502/504) come back as HTML or without GraphQL errors; is_page_timeout recognises them
+    if result.status_code in http_client.GATEWAY_TIMEOUT_STATUS_CODES:
+        return {"errors": [{"message": f"HTTP {result.status_code}: {result.text[:200]}"}]}
+    try:
+        return result.json()
+    except ValueError:
+        return {"errors": [{"message": f"HTTP {result.status_code}: {result.text[:200]}"}]}
 
 
-def request_wiz_api_token(client_id, client_secret):
-    """Retrieve token to query the Wiz API.
-    :param client_id: the client id used in the API
-    :param client_secret: secret used in the API"""
+def read_graph_search(result):
+    """Return the graphSearch part of a query result, raising if the query failed."""
+    if not isinstance(result, dict) or not result.get('data'):
+        errors = result if isinstance(result, Exception) else result.get('errors')
+        raise RuntimeError(f"Wiz graphSearch failed: {errors}")
+    return result['data']['graphSearch']
 
-    auth_payload = {
-      'grant_type': 'client_credentials',
-      'audience': 'wiz-api',
-      'client_id': client_id,
-      'client_secret': client_secret
-    }
-    try:
-        response = requests.post(url="https://auth.app.wiz.io/oauth/token",
-                                headers=HEADERS_AUTH, data=auth_payload, timeout=180)
 
-    except requests.exceptions.HTTPError as e:
-        print(f"<p>Error authenticating to Wiz (4xx/5xx): {str(e)}</p>")
-        return e
+class PageSizer:
+    """Adapts the graphSearch page size (`first`) to how fast the API answers."""
 
-    except requests.exceptions.ConnectionError as e:
-        print(f"<p>Network problem (DNS failure, refused connection, etc): {str(e)}</p>")
-        return e
+    def __init__(self, size, minimum=MIN_PAGE_SIZE, maximum=MAX_PAGE_SIZE, fast_seconds=FAST_PAGE_SECONDS):
+        self.size = size
+        self.minimum = min(minimum, size)
+        self.maximum = max(maximum, size)
+        self.fast_seconds = fast_seconds
 
-    except requests.exceptions.Timeout as e:
-        print(f"<p>Request timed out: {str(e)}</p>")
-        return e
+    def shrink(self):
+        """Halve the page size after a timeout; returns False if it can't get any smaller."""
+        if self.size <= self.minimum:
+            return False
+        # never grow back to a size that already timed out
+        self.maximum = max(self.minimum, self.size - 1)
+        self.size = max(self.minimum, self.size // 2)
+        return True
 
-    try:
-        response_json = response.json()
-        token = response_json.get('access_token')
-        if not token:
-            message = f"Could not retrieve token from Wiz: {response_json.get('message')}"
-            raise ValueError(message)
-    except ValueError as exception:
-        message = f"Could not parse API response {exception}. Check Service Account details " \
-                    "and variables"
-        raise ValueError(message) from exception
+    def record(self, elapsed):
+        """Grow the page size after a page that came back quickly."""
+        if elapsed < self.fast_seconds and self.size < self.maximum:
+            self.size = min(self.maximum, self.size + max(self.size // 2, 1))
 
-    response_json_decoded = json.loads(
-        base64.standard_b64decode(pad_base64(token.split(".")[1]))
-    )
 
-    response_json_decoded = json.loads(
-        base64.standard_b64decode(pad_base64(token.split(".")[1]))
-    )
-    dc = response_json_decoded["dc"]
+def is_page_timeout(result):
+    """True if the page failed in a way a smaller page might avoid (timeouts and gateway errors)."""
+    if isinstance(result, requests.exceptions.Timeout):
+        return True
+    if isinstance(result, dict) and not result.get('data'):
+        messages = " ".join(str(error.get('message', '')) for error in result.get('errors') or [])
+        return any(marker in messages.lower() for marker in ("timeout", "timed out", "http 502", "http 504"))
+    return False
 
-    return token, dc
 
+def iter_graph_search_pages(query, variables, dc, prefetch=True, page_sizer=None):
+    """Yield graphSearch result pages one at a time, following the cursor until the last page.
 
-def pad_base64(data):
-    """Makes sure base64 data is padded
-    :param data: the data used in the API that being encoded"""
-    missing_padding = len(data) % 4
-    if missing_padding != 0:
-        data += "=" * (4 - missing_padding)
-    return data
+    With prefetch, the request for page N+1 is sent in the background as soon as its cursor
+    is known, so processing page N overlaps the network wait.
+    :param query: the graphql query used to fetch results
+    :param variables: the query variables; not modified, the cursor is set on a copy
+    :param dc: the Wiz data center returned alongside the API token
+    :param prefetch: request the next page while the current one is being processed
+    :param page_sizer: a PageSizer adapting `first`; without one the page size is fixed"""
+    variables = dict(variables)
+
+    def fetch_page(after):
+        page_variables = dict(variables, after=after)
+        if page_sizer:
+            page_variables['first'] = page_sizer.size
+        start = time.monotonic()
+        result = query_wiz_api(query, page_variables, dc, retry_timeouts=page_sizer is None)
+        return result, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        after = variables.get('after')
+        future = executor.submit(fetch_page, after)
+        while future:
+            result, elapsed = future.result()
+            if page_sizer and is_page_timeout(result) and page_sizer.shrink():
+                print(f"graphSearch page timed out, retrying with first={page_sizer.size}", file=sys.stderr)
+                future = executor.submit(fetch_page, after)
+                continue
+
+            graph_search = read_graph_search(result)
+            if page_sizer:
+                page_sizer.record(elapsed)
+            page_info = graph_search['pageInfo']
+            future = None
+            if page_info['hasNextPage']:
+                after = page_info['endCursor']
+                if prefetch:
+                    future = executor.submit(fetch_page, after)
+
+            yield graph_search
+
+            if page_info['hasNextPage'] and not prefetch:
+                future = executor.submit(fetch_page, after)
+
+
+def iter_dns_delegations(pages):
+    """Yield one flat record per DNS zone / NS record pair found in the graphSearch pages."""
+    for page in pages:
+        for node in page['nodes']:
+            entities = [entity for entity in node['entities'] if entity]
+            zone = next((entity for entity in entities if entity['type'] == 'DNS_ZONE'), {})
+            for record in entities:
+                if record['type'] != 'DNS_RECORD':
+                    continue
+                yield {
+                    "zone_id": zone.get('id'),
+                    "zone_name": zone.get('name'),
+                    "zone_properties": zone.get('properties'),
+                    "record_id": record['id'],
+                    "record_name": record['name'],
+                    "record_properties": record.get('properties'),
+                }
+
+
+def list_wiz_projects(dc):
+    """Return the id and name of every Wiz project the service account can see."""
+    projects = []
+    variables = {"first": 500}
+    while True:
+        result = query_wiz_api(PROJECTS_QUERY, variables, dc)
+        if not isinstance(result, dict) or not result.get('data'):
+            errors = result if isinstance(result, Exception) else result.get('errors')
+            raise RuntimeError(f"Listing Wiz projects failed: {errors}")
+        connection = result['data']['projects']
+        projects.extend(connection['nodes'])
+        if not connection['pageInfo']['hasNextPage']:
+            return projects
+        variables = dict(variables, after=connection['pageInfo']['endCursor'])
+
+
+def iter_sharded_delegations(query, variables, dc, projects, max_workers=SHARD_WORKERS, prefetch=True,
+                             page_size=None, adaptive=True, failed_projects=None):
+    """Run one paginated graphSearch per project concurrently and yield the merged delegations.
+
+    Delegations are yielded as soon as any shard produces them; a zone / NS record pair that
+    appears in several projects is yielded once. A shard that fails is reported on stderr and
+    the others continue.
+    :param projects: list of {"id", "name"} as returned by list_wiz_projects
+    :param max_workers: number of projects queried at the same time
+    :param page_size: initial page size per shard, defaults to variables["first"]
+    :param adaptive: give every shard its own PageSizer
+    :param failed_projects: optional list the ids of failed projects are appended to"""
+    results = queue.Queue(maxsize=1000)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up when the consumer stopped reading, instead of blocking on a full queue
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_shard(project):
+        error = None
+        try:
+            shard_variables = dict(variables, projectId=project['id'])
+            page_sizer = PageSizer(page_size or variables['first']) if adaptive else None
+            pages = iter_graph_search_pages(query, shard_variables, dc, prefetch, page_sizer)
+            for delegation in iter_dns_delegations(pages):
+                if not put(delegation):
+                    return
+        except Exception as e:
+            error = e
+        put((done, project, error))
+
+    seen = set()
+    finished = 0
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        for project in projects:
+            executor.submit(run_shard, project)
+        try:
+            while finished < len(projects):
+                item = results.get()
+                if isinstance(item, tuple) and item[0] is done:
+                    finished += 1
+                    _, project, error = item
+                    if error:
+                        print(f"Project {project['name']} ({project['id']}) failed: {error}", file=sys.stderr)
+                        if failed_projects is not None:
+                            failed_projects.append(project['id'])
+                    continue
+                key = (item['zone_id'], item['record_id'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield item
+        finally:
+            stop.set()
+
+
+DELEGATION_FIELDS = ["zone_id", "zone_name", "zone_properties", "record_id", "record_name", "record_properties"]
+
+
+def write_ndjson(delegations, output):
+    """Write each delegation as one JSON line as soon as it arrives."""
+    count = 0
+    for delegation in delegations:
+        output.write(json.dumps(delegation) + "\n")
+        output.flush()
+        count += 1
+    return count
+
+
+def write_csv(delegations, output):
+    """Write the delegations as CSV rows as soon as they arrive; properties are JSON encoded."""
+    csv_writer = csv.DictWriter(output, fieldnames=DELEGATION_FIELDS)
+    csv_writer.writeheader()
+    count = 0
+    for delegation in delegations:
+        delegation = dict(delegation, zone_properties=json.dumps(delegation['zone_properties']),
+                          record_properties=json.dumps(delegation['record_properties']))
+        csv_writer.writerow(delegation)
+        output.flush()
+        count += 1
+    return count
+
+
+WRITERS = {"ndjson": write_ndjson, "csv": write_csv}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fetch AWS DNS zones and their NS records from Wiz.")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file, '-' for stdout (default)")
+    parser.add_argument("-f", "--format", choices=sorted(WRITERS), default="ndjson",
+                        help="output format (default: %(default)s)")
+    parser.add_argument("--no-prefetch", dest="prefetch", action="store_false",
+                        help="wait for each page to be written before requesting the next one")
+    parser.add_argument("-p", "--profile", choices=sorted(QUERY_PROFILES), default=DEFAULT_PROFILE,
+                        help="query profile selecting which expansions Wiz computes (default: %(default)s)")
+    parser.add_argument("--page-size", type=int, default=VARIABLES["first"],
+                        help="initial number of results per page (default: %(default)s)")
+    parser.add_argument("--fixed-page-size", dest="adaptive", action="store_false",
+                        help="keep the page size fixed instead of adapting it to response times")
+    parser.add_argument("--sharded", action="store_true",
+                        help="list the Wiz projects and query them concurrently instead of one tenant-wide search")
+    parser.add_argument("--shard-workers", type=int, default=SHARD_WORKERS,
+                        help="projects queried concurrently in sharded mode (default: %(default)s)")
+    parser.add_argument("--project", dest="projects", action="append", metavar="ID",
+                        help="only query this project id in sharded mode; may be repeated")
+    parser.add_argument("--store", metavar="PATH",
+                        help="also update the local SQLite store of zones and NS records (see dns_store.py)")
+    args = parser.parse_args()
+    if args.projects and not args.sharded:
+        parser.error("--project requires --sharded")
+    return args
 
 
 def main():
     """Main function"""
+    args = parse_args()
 
-    print("Getting token.")
+    print("Getting token.", file=sys.stderr)
     token, dc = request_wiz_api_token(CLIENT_ID, CLIENT_SECRET)
     HEADERS["Authorization"] = "Bearer " + token
 
-    result = query_wiz_api(QUERY, VARIABLES, dc)
-    print(result)  #DATA IS HERE
+    variables = dict(VARIABLES, first=args.page_size, **QUERY_PROFILES[args.profile])
+    failed_projects = []
+    if args.sharded:
+        if args.projects:
+            projects = [{"id": project_id, "name": project_id} for project_id in args.projects]
+        else:
+            projects = list_wiz_projects(dc)
+        print(f"Querying {len(projects)} projects with {args.shard_workers} workers.", file=sys.stderr)
+        delegations = iter_sharded_delegations(QUERY, variables, dc, projects, args.shard_workers, args.prefetch,
+                                               args.page_size, args.adaptive, failed_projects)
+    else:
+        page_sizer = PageSizer(args.page_size) if args.adaptive else None
+        pages = iter_graph_search_pages(QUERY, variables, dc, args.prefetch, page_sizer)
+        delegations = iter_dns_delegations(pages)
+    store = DnsStore(args.store) if args.store else None
+    if store:
+        store.begin_run()
+        delegations = store.record(delegations)
 
-    pageInfo = result['data']['graphSearch']['pageInfo']
-    while (pageInfo['hasNextPage']): #FETCH NEXT PAGE
-        VARIABLES['after'] = pageInfo['endCursor']
-        result = query_wiz_api(QUERY, VARIABLES, dc)
-        print(result)
-        pageInfo = result['data']['graphSearch']['pageInfo']
+    write = WRITERS[args.format]
+    try:
+        if args.output == "-":
+            count = write(delegations, sys.stdout)
+        else:
+            with open(args.output, "w", newline="") as output:
+                count = write(delegations, output)
+    except BaseException:
+        if store:
+            store.finish_run(complete=False)
+        raise
+    print(f"Wrote {count} DNS delegation records.", file=sys.stderr)
+    if store:
+        # Zones and records missing from an incomplete sweep (a project failed or a restricted
+        # --project list) aren't marked deleted
+        store.finish_run(complete=not failed_projects and not args.projects)
+        store.close()
+        print(f"Updated the DNS store {args.store}.", file=sys.stderr)
+        if store.unreadable:
+            print(f"WARNING: {store.unreadable} NS records have no '{NAMESERVER_PROPERTY}' property, "
+                  f"their nameservers are unknown (see dns_store.py properties).", file=sys.stderr)
+    if failed_projects:
+        print(f"{len(failed_projects)} projects failed: {', '.join(failed_projects)}", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
     main()
-    
\ No newline at end of file
@@ -0,0 +1,118 @@
+import base64
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.base64_utils import pad_base64
+
+'''Headers used for the OAuth client-credentials exchange'''
+HEADERS_AUTH = {"Content-Type": "application/x-www-form-urlencoded"}
+
+'''Optional file that keeps tokens between runs (written with 0600 permissions); disabled when unset'''
+TOKEN_CACHE_FILE = os.getenv("WIZ_TOKEN_CACHE_FILE")
+
+'''Tokens are refreshed this many seconds before their `exp` claim'''
+TOKEN_EXPIRY_MARGIN = 300
+
+# client_id -> {"token": ..., "dc": ..., "expires_at": ...}
+_token_cache = {}
+_token_lock = threading.Lock()
+
+
+def decode_jwt_payload(token):
+    """Decode the (unverified) claims of a JWT.
+    :param token: the JWT access token"""
+    return json.loads(base64.urlsafe_b64decode(pad_base64(token.split(".")[1])))
+
+
+def fetch_wiz_token(client_id, client_secret):
+    """Perform the client-credentials exchange and return the token with its dc and expiry.
+    :param client_id: the client id used in the API
+    :param client_secret: secret used in the API"""
+
+    auth_payload = {
+      'grant_type': 'client_credentials',
+      'audience': 'wiz-api',
+      'client_id': client_id,
+      'client_secret': client_secret
+    }
+    try:
+        response = http_client.post(url="https://auth.app.wiz.io/oauth/token",
+                                    headers=HEADERS_AUTH, data=auth_payload, timeout=180, idempotent=True)
+
+    except requests.exceptions.HTTPError as e:
+        print(f"<p>Error authenticating to Wiz (4xx/5xx): {str(e)}</p>", file=sys.stderr)
+        raise
+
+    except requests.exceptions.ConnectionError as e:
+        print(f"<p>Network problem (DNS failure, refused connection, etc): {str(e)}</p>", file=sys.stderr)
+        raise
+
+    except requests.exceptions.Timeout as e:
+        print(f"<p>Request timed out: {str(e)}</p>", file=sys.stderr)
+        raise
+
+    try:
+        response_json = response.json()
+        token = response_json.get('access_token')
+        if not token:
+            message = f"Could not retrieve token from Wiz: {response_json.get('message')}"
+            raise ValueError(message)
+    except ValueError as exception:
+        message = f"Could not parse API response {exception}. Check Service Account details " \
+                    "and variables"
+        raise ValueError(message) from exception
+
+    claims = decode_jwt_payload(token)
+    expires_at = claims.get("exp") or time.time() + response_json.get("expires_in", 0)
+    return {"token": token, "dc": claims["dc"], "expires_at": expires_at}
+
+
+def is_token_valid(entry):
+    return bool(entry) and entry.get("expires_at", 0) - TOKEN_EXPIRY_MARGIN > time.time()
+
+
+def load_token_cache_file(cache_file):
+    try:
+        with open(cache_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_token_cache_file(cache_file, client_id, entry):
+    """Store the token in the cache file, readable by the current user only."""
+    cache = load_token_cache_file(cache_file)
+    cache[client_id] = entry
+    tmp_file = f"{cache_file}.tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as file:
+        json.dump(cache, file)
+    os.chmod(tmp_file, 0o600)
+    os.replace(tmp_file, cache_file)
+
+
+def request_wiz_api_token(client_id, client_secret, force_refresh=False, cache_file=TOKEN_CACHE_FILE):
+    """Retrieve token to query the Wiz API, reusing a cached token until shortly before it expires.
+    :param client_id: the client id used in the API
+    :param client_secret: secret used in the API
+    :param force_refresh: ignore cached tokens, e.g. after the API answered 401
+    :param cache_file: optional file to share tokens between runs"""
+    with _token_lock:
+        entry = None if force_refresh else _token_cache.get(client_id)
+        if not is_token_valid(entry) and cache_file and not force_refresh:
+            entry = load_token_cache_file(cache_file).get(client_id)
+
+        if not is_token_valid(entry):
+            entry = fetch_wiz_token(client_id, client_secret)
+            if cache_file:
+                save_token_cache_file(cache_file, client_id, entry)
+
+        _token_cache[client_id] = entry
+        return entry["token"], entry["dc"]